@@ -1,3 +1,5 @@
+import math
+import time
 from dash import (
     Dash,
     dcc,
@@ -5,14 +7,39 @@ from dash import (
     Input,
     Output,
     State,
+    ClientsideFunction,
     no_update,
     exceptions,
 )
+from flask import Flask, Response, g, jsonify, redirect, request
+from spotipy.exceptions import SpotifyException
+from feature_store import TrackRecord
 from functions import (
     get_track_uri,
+    get_metadata,
     get_audio_features,
     get_audio_analysis,
+    get_waveform,
+    get_waveform_asset,
+    get_waveform_asset_name,
+    asset_extensions,
+    get_similar_tracks,
+    get_percentile_ranks,
+    compare_tracks,
+    comparison_figures,
+    compare_limit,
+    get_suggestions,
+    get_suggestions_index,
+    fan_out,
     audio_feature_description,
+    waveform_render,
+)
+from metrics import (
+    Histogram,
+    Timings,
+    profiler_from_environment,
+    registry,
+    request_seconds,
 )
 
 
@@ -23,8 +50,22 @@ colors = {
     "pink": "#e246ab",
 }
 
+server = Flask(__name__)
+# responses are compressed with Brotli or gzip (whichever the browser accepts), including
+# SVG waveforms, which are mostly path data
+server.config["COMPRESS_MIMETYPES"] = [
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/xml",
+    "application/json",
+    "application/javascript",
+    "image/svg+xml",
+]
 app = Dash(
     __name__,
+    server=server,
+    compress=True,
     meta_tags=[
         {
             "name": "viewport",
@@ -32,9 +73,46 @@ app = Dash(
         }
     ],
 )
-server = app.server
 app.title = "Spotify Data Visualizer"
 
+# how long searches take to show their first content, as measured in the browser
+first_content = Timings()
+first_content_seconds = registry.register(
+    Histogram(
+        "first_content_seconds",
+        "Time from submitting a search to its first content, measured in the browser.",
+    )
+)
+# saves profiles of slow requests while switched on, see metrics.SlowRequestProfiler
+profiler = profiler_from_environment()
+
+# "graph" waveforms are drawn by a dcc.Graph, the image render modes by an html.Img.
+# "pyramid" waveforms are kept in a dcc.Store and drawn into a zoomable dcc.Graph by a
+# clientside callback, which picks the resolution for the visible range as the user
+# zooms and pans, without calling the server.
+if waveform_render == "pyramid":
+    waveform = html.Div(
+        children=[
+            dcc.Store(id="waveform"),
+            dcc.Graph(
+                id="waveform-zoom",
+                config={"displayModeBar": False, "doubleClick": "reset"},
+            ),
+        ],
+    )
+    waveform_property = "data"
+elif waveform_render == "graph":
+    waveform = dcc.Graph(
+        id="waveform",
+        config={"staticPlot": True},
+    )
+    waveform_property = "figure"
+else:
+    waveform = html.Img(
+        id="waveform",
+    )
+    waveform_property = "src"
+
 app.layout = html.Div(
     id="container",
     children=[
@@ -53,12 +131,20 @@ app.layout = html.Div(
             placeholder="Search for a track",
             type="text",
             value="",
+            list="query-suggestions",
+            autoComplete="off",
+        ),
+        html.Datalist(
+            id="query-suggestions",
         ),
         html.Button(
             id="submit-button",
             n_clicks=0,
             children="Submit",
         ),
+        dcc.Store(id="track"),
+        dcc.Store(id="search-started"),
+        dcc.Store(id="first-content"),
         html.Div(
             id="error-message",
             children="No results found",
@@ -91,11 +177,9 @@ app.layout = html.Div(
                 html.Div(
                     id="waveform-container",
                     children=[
-                        html.Img(
-                            id="waveform",
-                        ),
+                        waveform,
                         html.Div(
-                            children="The waveform for this track has been constructed by performing an audio analysis of the track's segments.",
+                            children="The waveform for this track has been constructed by performing an audio analysis of the track's segments. The shaded bands are the track's sections, brighter the more energetic they are, and the lines mark its bars and beats.",
                         ),
                     ],
                 ),
@@ -268,6 +352,57 @@ app.layout = html.Div(
                         ),
                     ],
                 ),
+                html.Div(
+                    id="similar-container",
+                    children=[
+                        html.Div(
+                            className="card-label",
+                            children="SIMILAR TRACKS",
+                        ),
+                        html.Div(id="similar-list"),
+                        html.Div(
+                            children="Tracks with the closest audio features among the tracks that have been searched for.",
+                        ),
+                    ],
+                ),
+            ],
+        ),
+        html.H2(
+            children="Compare Tracks",
+        ),
+        html.Div(
+            children="Search for up to {} tracks, one per line, to compare their audio features and waveforms.".format(
+                compare_limit
+            ),
+        ),
+        dcc.Textarea(
+            id="compare-input",
+            placeholder="One track per line",
+            value="",
+        ),
+        html.Button(
+            id="compare-button",
+            n_clicks=0,
+            children="Compare",
+        ),
+        html.Div(
+            id="compare-error",
+            style={
+                "display": "none",
+            },
+        ),
+        html.Div(
+            id="compare-container",
+            style={"display": "none"},
+            children=[
+                dcc.Graph(
+                    id="compare-features",
+                    config={"displayModeBar": False},
+                ),
+                dcc.Graph(
+                    id="compare-waveforms",
+                    config={"displayModeBar": False},
+                ),
             ],
         ),
     ],
@@ -275,29 +410,15 @@ app.layout = html.Div(
 
 
 # called when submit-button is clicked, query taken from query-input
+# The page then fills in over three callbacks that run in parallel once the track is
+# found, so the metadata doesn't wait on the audio features or the slower waveform.
 @app.callback(
     Output(component_id="error-message", component_property="style"),
-    Output(component_id="output-container", component_property="style"),
-    Output(component_id="image", component_property="src"),
-    Output(component_id="name", component_property="children"),
-    Output(component_id="artist", component_property="children"),
-    Output(component_id="album", component_property="children"),
-    Output(component_id="preview", component_property="src"),
-    Output(component_id="preview", component_property="style"),
-    Output(component_id="waveform", component_property="src"),
-    Output(component_id="danceability-card-value", component_property="children"),
-    Output(component_id="valence-card-value", component_property="children"),
-    Output(component_id="energy-card-value", component_property="children"),
-    Output(component_id="tempo-card-value", component_property="children"),
-    Output(component_id="loudness-card-value", component_property="children"),
-    Output(component_id="speechiness-card-value", component_property="children"),
-    Output(component_id="instrumentalness-card-value", component_property="children"),
-    Output(component_id="liveness-card-value", component_property="children"),
-    Output(component_id="acousticness-card-value", component_property="children"),
+    Output(component_id="track", component_property="data"),
     Input(component_id="submit-button", component_property="n_clicks"),
     State(component_id="query-input", component_property="value"),
 )
-def update_output(n_clicks, query):
+def search(n_clicks, query):
     if n_clicks == 0:  # at start of app, don't update anything
         raise exceptions.PreventUpdate
     uri = get_track_uri(query)  # search Spotify using query
@@ -308,27 +429,36 @@ def update_output(n_clicks, query):
                 "color": "red",
                 "text-align": "center",
             },
-            no_update,  # output-container style
-            no_update,  # image src
-            no_update,  # name children
-            no_update,  # artist children
-            no_update,  # album children
-            no_update,  # preview src
-            no_update,  # preview style
-            no_update,  # waveform src
-            no_update,  # danceability-card-value children
-            no_update,  # valence-card-value children
-            no_update,  # energy-card-value children
-            no_update,  # tempo-card-value children
-            no_update,  # loudness-card-value children
-            no_update,  # speechiness-card-value children
-            no_update,  # instrumentalness-card-value children
-            no_update,  # liveness-card-value children
-            no_update,  # acousticness-card-value children
+            no_update,  # track data
         )
-    df = get_audio_features(uri)  # get metadata and audio features for track
-    if df.loc[0]["preview_url"] is not None:  # check if track has a preview
-        preview_src = df.loc[0]["preview_url"]
+    return (
+        {  # error-message style
+            "display": "none",
+        },
+        {  # track data, n_clicks makes every search update the store
+            "uri": uri,
+            "search": n_clicks,
+        },
+    )
+
+
+# called when a track has been found, shows its metadata first
+@app.callback(
+    Output(component_id="output-container", component_property="style"),
+    Output(component_id="image", component_property="src"),
+    Output(component_id="name", component_property="children"),
+    Output(component_id="artist", component_property="children"),
+    Output(component_id="album", component_property="children"),
+    Output(component_id="preview", component_property="src"),
+    Output(component_id="preview", component_property="style"),
+    Input(component_id="track", component_property="data"),
+    prevent_initial_call=True,
+)
+def update_metadata(track):
+    (response,) = fan_out([(get_metadata, track["uri"])])  # within the fetch timeout
+    metadata = TrackRecord.from_api(track["uri"], response, None)
+    if metadata.preview_url is not None:  # check if track has a preview
+        preview_src = metadata.preview_url
         preview_style = {
             "display": "block",
             "margin-top": "1rem",
@@ -338,10 +468,7 @@ def update_output(n_clicks, query):
         preview_style = {
             "display": "none",
         }
-    return (  # update output
-        {  # error-message style
-            "display": "none",
-        },
+    return (
         {  # output-container style
             "display": "flex",
             "flex-direction": "column",
@@ -349,26 +476,242 @@ def update_output(n_clicks, query):
             "align-items": "center",
             "gap": "1rem",
         },
-        df.loc[0]["image"],  # image src
-        df.loc[0]["name"],  # name children
-        "by {}".format(df.loc[0]["artist"]),  # artist children
-        "on {}".format(df.loc[0]["album"]),  # album children
+        metadata.image,  # image src
+        metadata.name,  # name children
+        "by {}".format(metadata.artist),  # artist children
+        "on {}".format(metadata.album),  # album children
         preview_src,  # preview src
         preview_style,  # preview style
-        get_audio_analysis(uri),  # waveform src
-        "{}".format(df.loc[0]["danceability"]),  # danceability-card-value children
-        "{}".format(df.loc[0]["valence"]),  # valence-card-value children
-        "{}".format(df.loc[0]["energy"]),  # energy-card-value children
-        "{}".format(df.loc[0]["tempo"]),  # tempo-card-value children
-        "{}".format(df.loc[0]["loudness"]),  # loudness-card-value children
-        "{}".format(df.loc[0]["speechiness"]),  # speechiness-card-value children
-        "{}".format(
-            df.loc[0]["instrumentalness"]
+    )
+
+
+# value shown in a feature card, followed by its percentile ranks among every track seen
+# and among the artist's tracks when there are enough to rank against
+def card_value(record, feature, ranks):
+    overall, artist = ranks[feature]
+    if overall is None:
+        return "{}".format(getattr(record, feature))
+    rank = "Higher than {:.0f}% of tracks".format(overall)
+    if artist is not None:
+        rank += " and {:.0f}% of {}'s".format(artist, record.artist)
+    return [
+        "{}".format(getattr(record, feature)),
+        html.Div(className="card-rank", children=rank),
+    ]
+
+
+# called when a track has been found, fills in the audio feature cards and similar tracks
+@app.callback(
+    Output(component_id="danceability-card-value", component_property="children"),
+    Output(component_id="valence-card-value", component_property="children"),
+    Output(component_id="energy-card-value", component_property="children"),
+    Output(component_id="tempo-card-value", component_property="children"),
+    Output(component_id="loudness-card-value", component_property="children"),
+    Output(component_id="speechiness-card-value", component_property="children"),
+    Output(component_id="instrumentalness-card-value", component_property="children"),
+    Output(component_id="liveness-card-value", component_property="children"),
+    Output(component_id="acousticness-card-value", component_property="children"),
+    Output(component_id="similar-list", component_property="children"),
+    Input(component_id="track", component_property="data"),
+    prevent_initial_call=True,
+)
+def update_features(track):
+    record = get_audio_features(track["uri"])  # get metadata and audio features
+    ranks = get_percentile_ranks(record)  # ranks among every track seen
+    return (
+        card_value(record, "danceability", ranks),  # danceability-card-value children
+        card_value(record, "valence", ranks),  # valence-card-value children
+        card_value(record, "energy", ranks),  # energy-card-value children
+        card_value(record, "tempo", ranks),  # tempo-card-value children
+        card_value(record, "loudness", ranks),  # loudness-card-value children
+        card_value(record, "speechiness", ranks),  # speechiness-card-value children
+        card_value(
+            record, "instrumentalness", ranks
         ),  # instrumentalness-card-value children
-        "{}".format(df.loc[0]["liveness"]),  # liveness-card-value children
-        "{}".format(df.loc[0]["acousticness"]),  # acousticness-card-value children
+        card_value(record, "liveness", ranks),  # liveness-card-value children
+        card_value(record, "acousticness", ranks),  # acousticness-card-value children
+        [  # similar-list children
+            html.Div(
+                className="similar-track",
+                children="{} by {}".format(similar.name, similar.artist),
+            )
+            for similar in get_similar_tracks(record)
+        ],
     )
 
 
+# called when a track has been found, draws its waveform last since it is the slowest
+@app.callback(
+    Output(component_id="waveform", component_property=waveform_property),
+    Input(component_id="track", component_property="data"),
+    prevent_initial_call=True,
+)
+def update_waveform(track):
+    if waveform_property == "src":  # images are served from /waveforms, not inlined
+        name = get_waveform(track["uri"], get_waveform_asset_name)
+        return None if name is None else "/waveforms/" + name
+    waveform = get_waveform(track["uri"], get_audio_analysis)  # figure or pyramid
+    if waveform is None and waveform_property == "figure":
+        return {"data": [], "layout": {}}
+    return waveform  # None (no waveform) if it took too long
+
+
+# called when compare-button is clicked, one query per line taken from compare-input
+@app.callback(
+    Output(component_id="compare-error", component_property="children"),
+    Output(component_id="compare-error", component_property="style"),
+    Output(component_id="compare-container", component_property="style"),
+    Output(component_id="compare-features", component_property="figure"),
+    Output(component_id="compare-waveforms", component_property="figure"),
+    Input(component_id="compare-button", component_property="n_clicks"),
+    State(component_id="compare-input", component_property="value"),
+    prevent_initial_call=True,
+)
+def compare(n_clicks, text):
+    records, not_found, levels, durations = compare_tracks((text or "").splitlines())
+    if not_found:  # list the queries nothing was found for
+        error = "No results found for: {}".format(", ".join(not_found))
+        error_style = {
+            "display": "block",
+            "color": "red",
+            "text-align": "center",
+        }
+    else:
+        error = ""
+        error_style = {
+            "display": "none",
+        }
+    if not records:
+        return error, error_style, {"display": "none"}, no_update, no_update
+    features_figure, waveforms_figure = comparison_figures(records, levels, durations)
+    return (
+        error,  # compare-error children
+        error_style,  # compare-error style
+        {"display": "block"},  # compare-container style
+        features_figure,  # compare-features figure
+        waveforms_figure,  # compare-waveforms figure
+    )
+
+
+# records when a search starts and, once its metadata is shown, reports how long the
+# page took to show it (time to first content) to /metrics/first-content
+app.clientside_callback(
+    ClientsideFunction(namespace="timing", function_name="start"),
+    Output(component_id="search-started", component_property="data"),
+    Input(component_id="submit-button", component_property="n_clicks"),
+    prevent_initial_call=True,
+)
+app.clientside_callback(
+    ClientsideFunction(namespace="timing", function_name="firstContent"),
+    Output(component_id="first-content", component_property="data"),
+    Input(component_id="name", component_property="children"),
+    State(component_id="search-started", component_property="data"),
+    prevent_initial_call=True,
+)
+
+
+# suggestions for a partly typed search query
+@server.route("/autocomplete")
+def autocomplete():
+    return jsonify(get_suggestions().lookup(request.args.get("q", "")))
+
+
+# every suggestion, for the search box to look up locally as the user types. Browsers keep
+# it for a while and then check it with its ETag.
+@server.route("/autocomplete/index")
+def autocomplete_index():
+    version, data = get_suggestions_index()
+    response = Response(data, mimetype="application/json")
+    response.set_etag(version)
+    response.headers["Cache-Control"] = "public, max-age=600"
+    return response.make_conditional(request)
+
+
+# waveform images by content hash: a URL always serves the same image, so browsers and
+# CDNs can keep it for good. An image evicted from the cache is drawn again from its track,
+# and if the track is drawn differently by now, the browser is sent to the new image.
+@server.route("/waveforms/<track_id>/<digest>.<extension>")
+def waveform_asset(track_id, digest, extension):
+    asset = get_waveform_asset(digest)
+    if asset is None and track_id.isalnum():
+        try:
+            name = get_waveform_asset_name("spotify:track:" + track_id)
+        except SpotifyException:
+            return "", 404
+        if name != "{}/{}.{}".format(track_id, digest, extension):
+            return redirect("/waveforms/" + name)
+        asset = get_waveform_asset(digest)
+    if asset is None or asset_extensions.get(asset[0]) != extension:
+        return "", 404
+    mimetype, data = asset
+    response = Response(data, mimetype=mimetype)
+    response.set_etag(digest)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response.make_conditional(request)
+
+
+# receives the time to first content of a search measured in the browser
+@server.route("/metrics/first-content", methods=["POST"])
+def record_first_content():
+    try:
+        seconds = float(request.get_data()) / 1000
+    except ValueError:
+        return "", 400
+    if not math.isfinite(seconds) or seconds < 0:
+        return "", 400
+    first_content.record(seconds)
+    first_content_seconds.observe(seconds)
+    return "", 204
+
+
+# summary of recent times to first content in seconds
+@server.route("/metrics/first-content", methods=["GET"])
+def report_first_content():
+    return jsonify(first_content.summary())
+
+
+# redraws the zoomable waveform in the browser when its pyramid changes or the user zooms
+if waveform_render == "pyramid":
+    app.clientside_callback(
+        ClientsideFunction(namespace="waveform", function_name="draw"),
+        Output(component_id="waveform-zoom", component_property="figure"),
+        Input(component_id="waveform", component_property="data"),
+        Input(component_id="waveform-zoom", component_property="relayoutData"),
+    )
+
+
+# name of what a request serves in the request metrics: the outputs of a Dash callback,
+# or the route of any other request (so assets share one name rather than one each)
+def request_name():
+    if request.path == "/_dash-update-component":
+        body = request.get_json(silent=True) or {}
+        return body.get("output", request.path)
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+
+@server.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    profiler.start()
+
+
+# on teardown rather than after the request, so requests that fail are recorded too
+@server.teardown_request
+def record_request_time(exception):
+    if "request_started" not in g:
+        return
+    name = request_name()
+    request_seconds.observe(time.perf_counter() - g.request_started, name=name)
+    profiler.stop(name)
+
+
+# every metric of this worker in the Prometheus text format
+@server.route("/metrics")
+def report_metrics():
+    return Response(registry.expose(), mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     app.run_server(debug=True)
@@ -0,0 +1,103 @@
+// Search suggestions for query-input, answered in the browser from a copy of the server's
+// prefix index (see suggest.py) so typing doesn't wait on a network round trip. The index
+// only holds tracks that searches found, never what visitors typed.
+
+const suggestionLimit = 8;
+const suggestionDelay = 30; // milliseconds to wait for the user to stop typing
+const indexMaxAge = 60000; // milliseconds before the index is fetched again
+
+let suggestionIndex = { keys: [], labels: [] };
+let indexFetched = 0;
+let suggestionTimer = null;
+
+// Same folding as normalize_query in suggest.py. Upper- then lower-casing folds letters
+// such as "ß" to "ss" the way Python's casefold does, so the keys match.
+function normalizeQuery(query) {
+  return query
+    .toUpperCase()
+    .toLowerCase()
+    .normalize("NFKD")
+    .replace(/\p{M}/gu, "")
+    .split(/\s+/)
+    .filter(Boolean)
+    .join(" ");
+}
+
+// Fetch the index again once the copy is old. The server sends it with an ETag, so an
+// unchanged index costs only a revalidation.
+function refreshSuggestionIndex() {
+  if (Date.now() - indexFetched < indexMaxAge) {
+    return;
+  }
+  indexFetched = Date.now();
+  fetch("/autocomplete/index")
+    .then(function (response) {
+      return response.json();
+    })
+    .then(function (index) {
+      suggestionIndex = index;
+    });
+}
+
+// Index of the first key that is not less than value.
+function lowerBound(keys, value) {
+  let lo = 0;
+  let hi = keys.length;
+  while (lo < hi) {
+    const mid = (lo + hi) >> 1;
+    if (keys[mid] < value) {
+      lo = mid + 1;
+    } else {
+      hi = mid;
+    }
+  }
+  return lo;
+}
+
+function lookupSuggestions(prefix) {
+  prefix = normalizeQuery(prefix);
+  if (!prefix) {
+    return [];
+  }
+  const keys = suggestionIndex.keys;
+  const labels = [];
+  for (
+    let i = lowerBound(keys, prefix);
+    i < keys.length && keys[i].startsWith(prefix) && labels.length < suggestionLimit;
+    i++
+  ) {
+    labels.push(suggestionIndex.labels[i]);
+  }
+  return labels;
+}
+
+function showSuggestions(query) {
+  const list = document.getElementById("query-suggestions");
+  if (!list) {
+    return;
+  }
+  list.replaceChildren(
+    ...lookupSuggestions(query).map(function (label) {
+      const option = document.createElement("option");
+      option.value = label;
+      return option;
+    })
+  );
+}
+
+document.addEventListener("focusin", function (event) {
+  if (event.target.id === "query-input") {
+    refreshSuggestionIndex();
+  }
+});
+
+document.addEventListener("input", function (event) {
+  if (event.target.id !== "query-input") {
+    return;
+  }
+  clearTimeout(suggestionTimer);
+  const query = event.target.value;
+  suggestionTimer = setTimeout(function () {
+    showSuggestions(query);
+  }, suggestionDelay);
+});
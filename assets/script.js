@@ -1,5 +1,25 @@
+// Enter submits a search, except in the comparison box where it starts a new line.
 document.addEventListener("keydown", function (event) {
-  if (event.key === "Enter") {
+  if (event.key === "Enter" && event.target.id !== "compare-input") {
     document.getElementById("submit-button").click();
   }
 });
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+  timing: {
+    // Remember when a search was submitted.
+    start: function (n_clicks) {
+      return performance.now();
+    },
+    // Once the track's metadata is shown, report how long it took since the search was
+    // submitted (time to first content, in milliseconds).
+    firstContent: function (name, started) {
+      if (started === null || started === undefined) {
+        return window.dash_clientside.no_update;
+      }
+      const elapsed = performance.now() - started;
+      navigator.sendBeacon("/metrics/first-content", String(elapsed));
+      return elapsed;
+    },
+  },
+});
@@ -0,0 +1,181 @@
+// Draws "pyramid" waveforms (see build_pyramid in waveform.py) in the browser.
+// The pyramid holds the track's levels at several resolutions, so zooming and panning
+// only picks a resolution and slices it, without a round trip to the server.
+
+// Decode an IEEE 754 half precision float from its 16 bits.
+function halfToFloat(bits) {
+  const sign = bits & 0x8000 ? -1 : 1;
+  const exponent = (bits >> 10) & 0x1f;
+  const fraction = bits & 0x3ff;
+  if (exponent === 0) {
+    return sign * Math.pow(2, -14) * (fraction / 1024);
+  }
+  if (exponent === 0x1f) {
+    return fraction ? NaN : sign * Infinity;
+  }
+  return sign * Math.pow(2, exponent - 15) * (1 + fraction / 1024);
+}
+
+// Decode the base64 float16 levels of every resolution, remembering them per pyramid.
+const decodedPyramids = new WeakMap();
+function decodePyramid(pyramid) {
+  if (!decodedPyramids.has(pyramid)) {
+    const decoded = {};
+    Object.keys(pyramid.levels).forEach(function (bins) {
+      const bytes = atob(pyramid.levels[bins]);
+      const levels = new Float32Array(bytes.length / 2);
+      for (let i = 0; i < levels.length; i++) {
+        levels[i] = halfToFloat(
+          bytes.charCodeAt(2 * i) | (bytes.charCodeAt(2 * i + 1) << 8)
+        );
+      }
+      decoded[bins] = levels;
+    });
+    decodedPyramids.set(pyramid, decoded);
+  }
+  return decodedPyramids.get(pyramid);
+}
+
+// Levels between start and end (fractions of the track) for drawing about `bars` bars,
+// from the coarsest resolution with enough bins, like pyramid_range in waveform.py.
+function pyramidRange(levels, start, end, bars) {
+  start = Math.max(0, start);
+  end = Math.min(1, end);
+  const resolutions = Object.keys(levels)
+    .map(Number)
+    .sort(function (a, b) {
+      return a - b;
+    });
+  let bins = resolutions[resolutions.length - 1];
+  for (let i = 0; i < resolutions.length; i++) {
+    if (resolutions[i] * (end - start) >= bars) {
+      bins = resolutions[i];
+      break;
+    }
+  }
+  const first = Math.floor(start * bins);
+  const last = Math.max(first + 1, Math.ceil(end * bins));
+  return { bins: bins, first: first, levels: levels[bins].slice(first, last) };
+}
+
+// A line trace of vertical lines at the given positions (fractions of the track), from
+// bottom to top, broken up by null gaps so any number of lines is one trace.
+function markerTrace(positions, duration, bottom, top, opacity) {
+  const x = [];
+  const y = [];
+  positions.forEach(function (position) {
+    x.push(position * duration, position * duration, null);
+    y.push(bottom, top, null);
+  });
+  return {
+    type: "scatter",
+    mode: "lines",
+    x: x,
+    y: y,
+    line: { color: "#ffffff", width: 1 },
+    opacity: opacity,
+    hoverinfo: "skip",
+  };
+}
+
+// The track's sections shaded behind the waveform, each as brightly as it is energetic,
+// like structure_shapes in functions.py.
+function sectionShapes(sections, duration) {
+  return sections.map(function (section) {
+    return {
+      type: "rect",
+      layer: "below",
+      xref: "x",
+      yref: "paper",
+      x0: section[0] * duration,
+      x1: section[1] * duration,
+      y0: 0,
+      y1: 1,
+      fillcolor: "#ffffff",
+      opacity: 0.04 + 0.16 * section[2],
+      line: { width: 0 },
+    };
+  });
+}
+
+// Pixels per bar to aim for when picking a resolution.
+const barPixels = 4;
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+  waveform: {
+    draw: function (pyramid, relayoutData) {
+      if (!pyramid || !pyramid.levels) {
+        return { data: [], layout: {} };
+      }
+      const duration = pyramid.duration;
+      let start = 0;
+      let end = duration;
+      // a new track opens unzoomed, whatever the zoom of the previous one was
+      const context = window.dash_clientside.callback_context;
+      const newTrack = (context && context.triggered ? context.triggered : []).some(
+        function (trigger) {
+          return trigger.prop_id === "waveform.data";
+        }
+      );
+      if (
+        !newTrack &&
+        relayoutData &&
+        relayoutData["xaxis.range[0]"] !== undefined
+      ) {
+        start = relayoutData["xaxis.range[0]"];
+        end = relayoutData["xaxis.range[1]"];
+      }
+      const graph = document.getElementById("waveform-zoom");
+      const width = graph && graph.clientWidth ? graph.clientWidth : 700;
+      const range = pyramidRange(
+        decodePyramid(pyramid),
+        start / duration,
+        end / duration,
+        width / barPixels
+      );
+      const step = duration / range.bins;
+      const x = Array.from(range.levels, function (level, i) {
+        return (range.first + i + 0.5) * step;
+      });
+      const structure = pyramid.structure;
+      const markers = structure
+        ? [
+            markerTrace(structure.bars, duration, -0.55, 0.55, 0.25),
+            markerTrace(structure.beats, duration, -0.55, -0.51, 0.5),
+          ]
+        : [];
+      return {
+        data: [
+          {
+            type: "bar",
+            x: x,
+            y: Array.from(range.levels),
+            base: Array.from(range.levels, function (level) {
+              return -level / 2;
+            }),
+            width: step * 0.8,
+            marker: { color: "#e246ab", line: { width: 0 } },
+            hoverinfo: "skip",
+          },
+        ].concat(markers),
+        layout: {
+          shapes: structure ? sectionShapes(structure.sections, duration) : [],
+          uirevision: duration,
+          showlegend: false,
+          dragmode: "zoom",
+          xaxis: { range: [start, end], showticklabels: false, showgrid: false },
+          yaxis: {
+            range: [-0.55, 0.55],
+            fixedrange: true,
+            showticklabels: false,
+            showgrid: false,
+            zeroline: false,
+          },
+          plot_bgcolor: "#191414",
+          paper_bgcolor: "#191414",
+          margin: { l: 0, r: 0, b: 0, t: 0 },
+        },
+      };
+    },
+  },
+});
@@ -0,0 +1,214 @@
+import argparse
+import json
+import os
+import sys
+from concurrent import futures
+from spotipy.exceptions import SpotifyException
+from feature_store import TrackRecord
+from functions import (
+    audio_features_limit,
+    chunks,
+    feature_store,
+    get_features_many,
+    get_metadata_many,
+    get_segments,
+    sp,
+)
+from waveform import bin_levels
+
+
+# Page through a paginated Spotify API response, yielding every item.
+def paginate(page):
+    while page:
+        yield from page["items"]
+        page = sp.next(page) if page.get("next") else None
+
+
+# Read the track URIs to process from a source: a playlist or album URI/URL, or the path
+# of a file with one track URI per line (blank lines and lines starting with # are skipped).
+def read_uris(source):
+    if os.path.isfile(source):
+        with open(source) as f:
+            lines = [line.strip() for line in f]
+        return [line for line in lines if line and not line.startswith("#")]
+    if "playlist" in source:
+        page = sp.playlist_items(source, additional_types=("track",))
+        items = paginate(page)
+        return [item["track"]["uri"] for item in items if item.get("track")]
+    if "album" in source:
+        page = sp.album_tracks(source)
+        return [item["uri"] for item in paginate(page)]
+    raise ValueError("Not a playlist, album or file of URIs: {}".format(source))
+
+
+# Get the waveform levels of a track, as a list of levels for the given number of bins.
+def get_levels(track_uri, bins):
+    segments = get_segments(track_uri)
+    index, levels = bin_levels(segments, segments.duration, bins=bins)
+    return levels.tolist()
+
+
+# Process track URIs in chunks, yielding one record per track in input order: the fields
+# of its TrackRecord plus its waveform levels. Records are also added to the feature store.
+# Metadata and audio features are fetched in batches, then the audio analyses of the chunk
+# run in parallel on `workers` threads.
+def analyse_tracks(track_uris, workers=4, bins=125):
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for chunk in chunks(track_uris, audio_features_limit):
+            analyses = [pool.submit(get_levels, uri, bins) for uri in chunk]
+            responses = zip(chunk, get_metadata_many(chunk), get_features_many(chunk))
+            records = {
+                uri: TrackRecord.from_api(uri, metadata, audio_features)
+                for uri, metadata, audio_features in responses
+                if metadata is not None  # skip URIs the API doesn't know about
+            }
+            feature_store.extend(list(records.values()))
+            for uri, analysis in zip(chunk, analyses):
+                if uri not in records:
+                    continue
+                try:
+                    levels = analysis.result()
+                except SpotifyException:  # some tracks have no audio analysis
+                    levels = None
+                yield dict(records[uri].to_dict(), waveform=levels)
+
+
+# Writes records as JSON lines, appending to an existing file. A line left incomplete by
+# an interrupted run is cut off first, so the file can be resumed.
+class JsonlWriter:
+    def __init__(self, path):
+        self.file = open(path, "a+b")
+        end = self.file.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            chunk = min(position, 65536)
+            self.file.seek(position - chunk)
+            newline = self.file.read(chunk).rfind(b"\n")
+            if newline != -1:
+                position = position - chunk + newline + 1
+                break
+            position -= chunk
+        if position != end:
+            self.file.truncate(position)
+        self.file.close()
+        self.file = open(path, "a")
+
+    def done(self):
+        if self.file.tell() == 0:
+            return set()
+        with open(self.file.name) as f:
+            return {json.loads(line)["uri"] for line in f if line.strip()}
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# Writes records as Parquet files in a directory. Every run writes new part files of up to
+# `rows` records each, so records already written survive an interrupted run.
+class ParquetWriter:
+    def __init__(self, path, rows=1000):
+        import pyarrow  # optional, only needed for Parquet output
+        import pyarrow.parquet
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.rows = rows
+        self.pending = []
+        os.makedirs(path, exist_ok=True)
+
+    def parts(self):
+        return sorted(
+            name for name in os.listdir(self.path) if name.endswith(".parquet")
+        )
+
+    def done(self):
+        return {
+            uri
+            for name in self.parts()
+            for uri in self.pq.read_table(
+                os.path.join(self.path, name), columns=["uri"]
+            )["uri"].to_pylist()
+        }
+
+    def flush(self):
+        if not self.pending:
+            return
+        name = "part-{:05d}.parquet".format(len(self.parts()))
+        self.pq.write_table(
+            self.pa.Table.from_pylist(self.pending), os.path.join(self.path, name)
+        )
+        self.pending = []
+
+    def write(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= self.rows:
+            self.flush()
+
+    def close(self):
+        self.flush()
+
+
+# Analyse every track from a source and stream the records to output.
+# Tracks already in output are skipped, so an interrupted run can be resumed by running
+# it again. Output is JSON lines, or a directory of Parquet files if output_format is
+# "parquet" (which needs pyarrow). Returns the number of records written.
+def run_batch(source, output, output_format="jsonl", workers=4, bins=125):
+    writer = (
+        ParquetWriter(output) if output_format == "parquet" else JsonlWriter(output)
+    )
+    try:
+        done = writer.done()
+        track_uris = [
+            uri for uri in dict.fromkeys(read_uris(source)) if uri not in done
+        ]
+        written = 0
+        for record in analyse_tracks(track_uris, workers=workers, bins=bins):
+            writer.write(record)
+            written += 1
+        return written
+    finally:
+        writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Get the audio features and waveform of every track in a playlist, album or file of track URIs."
+    )
+    parser.add_argument(
+        "source", help="playlist or album URI/URL, or a file of track URIs"
+    )
+    parser.add_argument(
+        "output", help="JSON lines file, or directory for Parquet output"
+    )
+    parser.add_argument(
+        "--format",
+        choices=["jsonl", "parquet"],
+        help="output format (default: parquet if output ends in .parquet, else jsonl)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="audio analyses to run at once"
+    )
+    parser.add_argument(
+        "--bins", type=int, default=125, help="number of waveform levels per track"
+    )
+    args = parser.parse_args(argv)
+    output_format = args.format or (
+        "parquet" if args.output.endswith(".parquet") else "jsonl"
+    )
+    written = run_batch(
+        args.source,
+        args.output,
+        output_format=output_format,
+        workers=args.workers,
+        bins=args.bins,
+    )
+    print("Wrote {} tracks to {}".format(written, args.output), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
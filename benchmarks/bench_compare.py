@@ -0,0 +1,49 @@
+import os
+import tempfile
+import time
+from benchmarks.fake_spotify import FakeSpotify
+
+scratch = tempfile.mkdtemp()
+os.environ["SPOTIFY_CACHE_PATH"] = os.path.join(scratch, "cache.sqlite")
+os.environ["FEATURE_STORE_PATH"] = os.path.join(scratch, "features")
+os.environ["SEGMENT_STORE_PATH"] = os.path.join(scratch, "segments")
+os.environ["SUGGESTIONS_PATH"] = os.path.join(scratch, "suggestions.json")
+import functions  # noqa: E402
+from client import CircuitBreaker, PooledSpotify, TokenBucket  # noqa: E402
+
+delays = {"search": 0.1, "tracks": 0.1, "audio_features": 0.1, "audio_analysis": 0.2}
+track_counts = (1, 2, 5, 10)
+
+
+# Compare fresh tracks (so nothing is cached) against a fake API with injected delays,
+# for growing numbers of tracks. Searches and analyses run concurrently and metadata and
+# audio features are batched, so the time should stay close to one track's.
+def main():
+    fake = FakeSpotify(delays=delays, segments=700).start()
+    functions.sp = PooledSpotify(
+        limiter=TokenBucket(rate=1000, burst=1000),
+        breaker=CircuitBreaker(threshold=100, cooldown=30),
+        auth="benchmark",
+    )
+    functions.sp.prefix = fake.prefix
+    print("injected delays: {}".format(delays))
+    print("{:>7} {:>10} {:>16}".format("tracks", "seconds", "API requests"))
+    try:
+        # warm up, so the first row doesn't include importing Plotly
+        records, not_found, levels, durations = functions.compare_tracks(["warm up"])
+        functions.comparison_figures(records, levels, durations)
+        for count in track_counts:
+            before = sum(fake.requests.values())
+            queries = ["compare {} {}".format(count, i) for i in range(count)]
+            start = time.perf_counter()
+            records, not_found, levels, durations = functions.compare_tracks(queries)
+            functions.comparison_figures(records, levels, durations)
+            elapsed = time.perf_counter() - start
+            requests = sum(fake.requests.values()) - before
+            print("{:>7} {:>10.3f} {:>16}".format(count, elapsed, requests))
+    finally:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
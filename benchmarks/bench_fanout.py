@@ -0,0 +1,74 @@
+import os
+import tempfile
+import time
+from concurrent import futures
+import spotipy
+from benchmarks.fake_spotify import FakeSpotify
+
+scratch = tempfile.mkdtemp()
+os.environ["SPOTIFY_CACHE_PATH"] = os.path.join(scratch, "cache.sqlite")
+os.environ["FEATURE_STORE_PATH"] = os.path.join(scratch, "features")
+os.environ["SIMILAR_INDEX_PATH"] = os.path.join(scratch, "similar.npz")
+os.environ["DISTRIBUTIONS_PATH"] = os.path.join(scratch, "distributions.npz")
+os.environ["SEGMENT_STORE_PATH"] = os.path.join(scratch, "segments")
+os.environ["SUGGESTIONS_PATH"] = os.path.join(scratch, "suggestions.json")
+os.environ["WAVEFORM_RENDER"] = "svg"
+import functions  # noqa: E402
+
+delays = {"track": 0.2, "audio_features": 0.2, "audio_analysis": 0.4}
+
+
+# Fetch a track's details one call after another, the way update_output used to.
+def serial(track_uri):
+    functions.get_metadata(track_uri)
+    functions.get_features(track_uri)
+    functions.analyse_and_render(track_uri, 125, "sample", functions.waveform_render)
+
+
+# Fetch a track's details the way the page's callbacks do, all at once.
+def concurrent(track_uri):
+    with futures.ThreadPoolExecutor(3) as callbacks:
+        calls = [
+            callbacks.submit(functions.get_metadata, track_uri),
+            callbacks.submit(functions.get_audio_features, track_uri),
+            callbacks.submit(functions.get_waveform, track_uri),
+        ]
+        for call in calls:
+            call.result()
+
+
+# Time fetching a fresh track (so nothing is cached) with the given function.
+def elapsed(function, track_id):
+    start = time.perf_counter()
+    function("spotify:track:" + track_id)
+    return time.perf_counter() - start
+
+
+# Fetch tracks from a local fake Spotify API with injected delays, once serially and once
+# concurrently, and check that the concurrent calls overlap: the total time should
+# be close to the slowest call rather than the sum of all of them.
+def main():
+    fake = FakeSpotify(delays=delays).start()
+    functions.sp = spotipy.Spotify(auth="benchmark", retries=0)
+    functions.sp.prefix = fake.prefix
+    try:
+        serial_s = elapsed(serial, "serial")
+        concurrent_s = elapsed(concurrent, "concurrent")
+    finally:
+        fake.stop()
+    print("injected delays: {}".format(delays))
+    print(
+        "serial:     {:.3f} s (sum of delays {:.3f} s)".format(
+            serial_s, sum(delays.values())
+        )
+    )
+    print(
+        "concurrent: {:.3f} s (slowest delay {:.3f} s)".format(
+            concurrent_s, max(delays.values())
+        )
+    )
+    assert concurrent_s < sum(delays.values()), "calls did not overlap"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import json
+import time
+from benchmarks.synthetic import make_audio_analysis
+from functions import render_waveform
+from waveform import bin_levels, build_pyramid, encode_pyramid, render_modes
+
+
+# Size in bytes of what the callback sends to the browser for a rendered waveform.
+def payload_bytes(rendered):
+    if isinstance(rendered, str):
+        return len(rendered.encode())
+    return len(json.dumps(rendered).encode())
+
+
+# Server CPU and wall time per render in milliseconds, averaged over a number of renders.
+# CPU time only covers this process, so for png the wall time also counts the work done
+# by Kaleido's Chromium subprocess.
+def render_ms(render, number):
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(number):
+        render()
+    cpu = (time.process_time() - cpu_start) / number * 1000
+    wall = (time.perf_counter() - wall_start) / number * 1000
+    return cpu, wall
+
+
+# Every render mode. The pyramid isn't rendered by render_waveform but built from the
+# segments and encoded for the browser to draw, so that's what is timed for it.
+def main():
+    audio_analysis = make_audio_analysis(2000)
+    segments, duration = audio_analysis["segments"], audio_analysis["track"]["duration"]
+    index, levels = bin_levels(segments, duration)
+    renders = {
+        mode: lambda mode=mode: render_waveform(index, levels, mode)
+        for mode in render_modes
+        if mode != "pyramid"
+    }
+    renders["pyramid"] = lambda: encode_pyramid(
+        build_pyramid(segments, duration), duration
+    )
+    print(
+        "{:>7} {:>10} {:>10} {:>14}".format(
+            "mode", "cpu ms", "wall ms", "payload bytes"
+        )
+    )
+    for mode, render in renders.items():
+        try:
+            rendered = render()
+        except Exception as e:  # png needs Kaleido, which may not be installed
+            print("{:>7} skipped: {}".format(mode, e))
+            continue
+        number = 5 if mode == "png" else 50
+        cpu, wall = render_ms(render, number)
+        print(
+            "{:>7} {:>10.2f} {:>10.2f} {:>14}".format(
+                mode, cpu, wall, payload_bytes(rendered)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
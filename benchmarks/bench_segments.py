@@ -0,0 +1,82 @@
+import json
+import os
+import tempfile
+import timeit
+import zlib
+from benchmarks.synthetic import make_long_audio_analysis
+from segments import SegmentFile, compressions, encode_segments, write_segments
+from waveform import segment_arrays
+
+
+track_lengths = (180, 600, 3600, 3 * 3600)
+
+
+# Best time of a few runs of a function, in milliseconds.
+def best_ms(function, number=5):
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1000
+
+
+# What the waveform needs from an analysis stored as JSON in the response cache: the blob
+# is decompressed and parsed in full before the three columns can be read.
+def load_json(blob):
+    audio_analysis = json.loads(zlib.decompress(blob))
+    return segment_arrays(
+        audio_analysis["segments"], audio_analysis["track"]["duration"]
+    )
+
+
+# The same from a segment file, which only reads the three columns.
+def load_segments(path):
+    segments = SegmentFile(path)
+    return segment_arrays(segments, segments.duration)
+
+
+# Compare the size of audio analyses stored as JSON and as segment files, and how long it
+# takes to load the arrays the waveform is built from out of each.
+def main():
+    directory = tempfile.mkdtemp()
+    available = []
+    for compression in compressions:
+        try:
+            encode_segments({"track": {"duration": 1}, "segments": []}, compression)
+            available.append(compression)
+        except ImportError:
+            print("{} is not available, skipping it".format(compression))
+    print(
+        "{:>8} {:>12} {:>12} {:>10} {:>12} {:>10}".format(
+            "seconds", "format", "compression", "bytes", "load ms", "speedup"
+        )
+    )
+    for seconds in track_lengths:
+        audio_analysis = make_long_audio_analysis(seconds, seed=seconds)
+        raw = json.dumps(audio_analysis, separators=(",", ":")).encode()
+        blob = zlib.compress(raw)
+        json_ms = best_ms(lambda: load_json(blob))
+        print(
+            "{:>8} {:>12} {:>12} {:>10} {:>12} {:>10}".format(
+                seconds, "json", "none", len(raw), "", ""
+            )
+        )
+        print(
+            "{:>8} {:>12} {:>12} {:>10} {:>12.2f} {:>10}".format(
+                seconds, "json", "zlib", len(blob), json_ms, "1.0x"
+            )
+        )
+        for compression in available:
+            path = os.path.join(directory, "{}-{}.seg".format(seconds, compression))
+            write_segments(path, audio_analysis, compression)
+            ms = best_ms(lambda: load_segments(path))
+            print(
+                "{:>8} {:>12} {:>12} {:>10} {:>12.2f} {:>9.0f}x".format(
+                    seconds,
+                    "segments",
+                    compression or "none",
+                    os.path.getsize(path),
+                    ms,
+                    json_ms / ms,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import time
+import numpy as np
+from similar import SimilarityIndex, scale_low, scale_span
+
+
+corpus_sizes = [10000, 100000, 1000000]
+queries = 200
+
+
+# Raw audio features for random tracks, spread over each feature's usual range.
+def random_features(count, rng):
+    return rng.random((count, len(scale_low)), dtype="f4") * scale_span + scale_low
+
+
+# Time similar-track queries against indexes of increasing size, and check how many of
+# the true 5 nearest tracks the index finds (recall), which drops below 1 once the index
+# switches to IVF search.
+def main():
+    rng = np.random.default_rng(0)
+    print(
+        "{:>9} {:>8} {:>10} {:>10} {:>8}".format(
+            "tracks", "mode", "build s", "query ms", "recall"
+        )
+    )
+    for size in corpus_sizes:
+        features = random_features(size, rng)
+        uris = np.array(["spotify:track:{}".format(i) for i in range(size)])
+        start = time.perf_counter()
+        index = SimilarityIndex()
+        index.add(uris, features)
+        build = time.perf_counter() - start
+        probes = random_features(queries, rng)
+        start = time.perf_counter()
+        found = [index.query(probe, k=5) for probe in probes]
+        query_ms = (time.perf_counter() - start) / queries * 1000
+        centroids, index.centroids = index.centroids, None
+        exact = [index.query(probe, k=5) for probe in probes[:20]]
+        index.centroids = centroids
+        recall = np.mean(
+            [
+                len({u for u, _ in a} & {u for u, _ in b}) / 5
+                for a, b in zip(found, exact)
+            ]
+        )
+        mode = "brute" if centroids is None else "ivf"
+        print(
+            "{:>9} {:>8} {:>10.2f} {:>10.3f} {:>8.2f}".format(
+                size, mode, build, query_ms, recall
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import os
+import subprocess
+import sys
+import time
+
+
+# Time each module takes to import (including the modules it imports), in milliseconds,
+# from Python's -X importtime report for a fresh interpreter importing `module`.
+def import_times(module):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+# Milliseconds from starting a fresh interpreter until the app has served its first page
+# and layout, as a worker without a preloaded app would.
+first_request = """
+import time
+started = time.perf_counter()
+from app import server
+client = server.test_client()
+client.get("/")
+client.get("/_dash-layout")
+print((time.perf_counter() - started) * 1000)
+"""
+
+
+def first_request_ms():
+    result = subprocess.run(
+        [sys.executable, "-c", first_request],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE="1"),
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    times = import_times("app")
+    print("Slowest imports (cumulative ms):")
+    for name, ms in sorted(times.items(), key=lambda item: -item[1])[:15]:
+        print("{:>10.1f}  {}".format(ms, name))
+    print("App modules (cumulative ms):")
+    for module in ("functions", "waveform", "cache", "client", "similar"):
+        print("{:>10.1f}  {}".format(times.get(module, 0), module))
+    started = time.perf_counter()
+    first = first_request_ms()
+    print(
+        "First request served {:.0f} ms after interpreter start "
+        "({:.0f} ms including interpreter startup)".format(
+            first, (time.perf_counter() - started) * 1000
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import timeit
+import numpy as np
+from benchmarks.synthetic import make_audio_analysis
+from waveform import bin_levels, track_structure
+
+
+segment_counts = [500, 1000, 2000, 5000, 10000, 20000]
+
+
+# The original nested-loop binning from get_audio_analysis, kept as the reference implementation.
+def legacy_levels(audio_analysis):
+    duration = audio_analysis["track"]["duration"]
+    segments = audio_analysis["segments"]
+    segments_map = np.zeros(shape=(len(segments), 3))
+    i = 0
+    for segment in segments:
+        segment_start = segment["start"] / duration
+        segment_duration = segment["duration"] / duration
+        segment_loudness = 1 - (min(max(segment["loudness_max"], -35), 0) / -35)
+        segments_map[i] = [segment_start, segment_duration, segment_loudness]
+        i += 1
+    maximum = np.amax(segments_map, axis=0)[2]
+    levels = []
+    for i in range(0, 1000, 1):
+        for segment in segments_map:
+            if segment[0] <= i / 1000 <= segment[0] + segment[1] and i % 8 == 0:
+                loudness = segment[2] / maximum
+                levels.append([i, loudness / 2, -loudness / 2])
+                break
+    return levels
+
+
+# The NumPy binning that get_audio_analysis now uses.
+def vectorized_levels(audio_analysis):
+    return bin_levels(audio_analysis["segments"], audio_analysis["track"]["duration"])
+
+
+# The binning plus the sections, bars and beats drawn over the waveform, which together
+# should stay far below the cost of the legacy binning alone.
+def structured_levels(audio_analysis):
+    duration = audio_analysis["track"]["duration"]
+    return (
+        bin_levels(audio_analysis["segments"], duration),
+        track_structure(audio_analysis, duration),
+    )
+
+
+# Time a function on an analysis, returning the best of a few runs in milliseconds.
+def best_ms(function, audio_analysis, number):
+    runs = timeit.repeat(lambda: function(audio_analysis), number=number, repeat=3)
+    return min(runs) / number * 1000
+
+
+def main():
+    print(
+        "{:>9} {:>12} {:>12} {:>15} {:>9} {:>10}".format(
+            "segments",
+            "legacy ms",
+            "vector ms",
+            "+structure ms",
+            "speedup",
+            "identical",
+        )
+    )
+    for count in segment_counts:
+        audio_analysis = make_audio_analysis(count, seed=count)
+        expected = legacy_levels(audio_analysis)
+        index, levels = vectorized_levels(audio_analysis)
+        identical = [row[0] for row in expected] == list(index) and [
+            row[1] for row in expected
+        ] == list(levels / 2)
+        legacy = best_ms(legacy_levels, audio_analysis, 1)
+        vector = best_ms(vectorized_levels, audio_analysis, 20)
+        structured = best_ms(structured_levels, audio_analysis, 20)
+        print(
+            "{:>9} {:>12.2f} {:>12.3f} {:>15.3f} {:>8.0f}x {:>10}".format(
+                count, legacy, vector, structured, legacy / vector, str(identical)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
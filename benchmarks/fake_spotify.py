@@ -0,0 +1,170 @@
+import gzip
+import json
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from benchmarks.synthetic import make_audio_analysis
+from suggest import normalize_query
+
+
+# Load recorded API responses saved by `python -m benchmarks.suite record`: a gzipped
+# JSON object of {endpoint: {key: response}} keyed the way the response cache keys them
+# (normalized queries for search, track URIs for the rest).
+def load_fixtures(path):
+    with gzip.open(path, "rt") as f:
+        return json.load(f)
+
+
+# Canned responses for a track, shaped like the Spotify Web API's.
+def make_track(track_id):
+    return {
+        "id": track_id,
+        "uri": "spotify:track:" + track_id,
+        "name": "Track " + track_id,
+        "preview_url": None,
+        "artists": [{"name": "Artist " + track_id}],
+        "album": {
+            "name": "Album " + track_id,
+            "artists": [{"name": "Artist " + track_id}],
+            "images": [
+                {"url": "https://example.com/640.jpg"},
+                {"url": "https://example.com/300.jpg"},
+                {"url": "https://example.com/64.jpg"},
+            ],
+        },
+    }
+
+
+def make_audio_features(track_id):
+    return {
+        "id": track_id,
+        "uri": "spotify:track:" + track_id,
+        "danceability": 0.5,
+        "valence": 0.5,
+        "energy": 0.5,
+        "tempo": 120.0,
+        "loudness": -8.0,
+        "speechiness": 0.05,
+        "instrumentalness": 0.0,
+        "liveness": 0.1,
+        "acousticness": 0.2,
+    }
+
+
+# A local stand-in for the Spotify Web API, serving canned responses after an injected
+# delay per endpoint ("search", "track", "tracks", "audio_features", "audio_analysis").
+# `failures` maps endpoints to HTTP statuses to answer their next requests with, such as
+# [429, 503] (429s come with a Retry-After of `retry_after` seconds).
+# Point a spotipy client at it by setting its prefix to the server's prefix.
+# Counts of requests per endpoint are kept in `requests`.
+# Given `fixtures` (see load_fixtures), recorded responses are replayed where there is
+# one and canned responses are made up for everything else.
+class FakeSpotify:
+    def __init__(
+        self, delays=None, segments=2000, failures=None, retry_after=1, fixtures=None
+    ):
+        self.fixtures = fixtures or {}
+        self.delays = delays or {}
+        self.segments = segments
+        self.failures = {k: list(v) for k, v in (failures or {}).items()}
+        self.retry_after = retry_after
+        self.requests = {}
+        self.responses = {}
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.prefix = "http://127.0.0.1:{}/v1/".format(self.server.server_port)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Work out which endpoint a path belongs to and the response body for it.
+    def respond(self, path, query):
+        parts = path.strip("/").split("/")[1:]
+        if parts[0] == "search":
+            recorded = self.recorded("search", normalize_query(query["q"][0]))
+            if recorded is not None:
+                return "search", recorded
+            track_id = str(zlib.crc32(query["q"][0].encode()))
+            return "search", {"tracks": {"items": [make_track(track_id)]}}
+        if parts[0] == "tracks" and len(parts) > 1 and parts[1]:
+            return "track", self.track(parts[1])
+        if parts[0] == "tracks":
+            ids = query["ids"][0].split(",")
+            return "tracks", {"tracks": [self.track(i) for i in ids]}
+        if parts[0] == "audio-features":
+            ids = query["ids"][0].split(",")
+            return "audio_features", {
+                "audio_features": [self.audio_features(i) for i in ids]
+            }
+        if parts[0] == "audio-analysis":
+            recorded = self.recorded("audio_analysis", parts[1])
+            if recorded is not None:
+                return "audio_analysis", recorded
+            seed = zlib.crc32(parts[1].encode())
+            return "audio_analysis", make_audio_analysis(self.segments, seed=seed)
+        return None, None
+
+    def recorded(self, endpoint, key):
+        responses = self.fixtures.get(endpoint, {})
+        if endpoint != "search" and not key.startswith("spotify:track:"):
+            key = "spotify:track:" + key
+        return responses.get(key)
+
+    def track(self, track_id):
+        recorded = self.recorded("track", track_id)
+        return make_track(track_id) if recorded is None else recorded
+
+    # The response cache keeps audio features as the list spotipy returns.
+    def audio_features(self, track_id):
+        recorded = self.recorded("audio_features", track_id)
+        return make_audio_features(track_id) if recorded is None else recorded[0]
+
+    # The endpoint and encoded body for a request path. Bodies are made once per path, so
+    # the time spent building them isn't counted against the client being measured.
+    def response(self, path):
+        with self.lock:
+            response = self.responses.get(path)
+        if response is None:
+            url = urlparse(path)
+            endpoint, body = self.respond(url.path, parse_qs(url.query))
+            response = endpoint, json.dumps(body).encode()
+            with self.lock:
+                self.responses[path] = response
+        return response
+
+    def handle(self, request):
+        endpoint, payload = self.response(request.path)
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            pending = self.failures.get(endpoint)
+            status = pending.pop(0) if pending else 200
+        time.sleep(self.delays.get(endpoint, 0))
+        if endpoint is None:
+            status = 404
+        if status != 200:
+            body = {"error": {"status": status, "message": "injected failure"}}
+            payload = json.dumps(body).encode()
+        request.send_response(status)
+        if status == 429:
+            request.send_header("Retry-After", str(self.retry_after))
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(payload)))
+        request.end_headers()
+        request.wfile.write(payload)
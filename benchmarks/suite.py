@@ -0,0 +1,352 @@
+import argparse
+import gzip
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from concurrent import futures
+import numpy as np
+from benchmarks.fake_spotify import FakeSpotify, load_fixtures
+from benchmarks.synthetic import make_long_audio_analysis
+
+scratch = tempfile.mkdtemp()
+os.environ["SPOTIFY_CACHE_PATH"] = os.path.join(scratch, "cache.sqlite")
+os.environ["FEATURE_STORE_PATH"] = os.path.join(scratch, "features")
+os.environ["SIMILAR_INDEX_PATH"] = os.path.join(scratch, "similar.npz")
+os.environ["SEGMENT_STORE_PATH"] = os.path.join(scratch, "segments")
+os.environ["SUGGESTIONS_PATH"] = os.path.join(scratch, "suggestions.json")
+os.environ.setdefault("WAVEFORM_RENDER", "svg")
+import functions  # noqa: E402
+from cache import ResponseCache  # noqa: E402
+from client import CircuitBreaker, PooledSpotify, TokenBucket  # noqa: E402
+from waveform import (  # noqa: E402
+    bin_levels,
+    build_pyramid,
+    encode_pyramid,
+    track_structure,
+)
+
+# The endpoints recorded into fixtures and replayed by the fake API.
+fixture_endpoints = ("search", "track", "audio_features", "audio_analysis")
+
+# Lengths in seconds of the synthetic tracks binning is timed on, from a pop song up to a
+# three hour mix.
+track_lengths = (180, 600, 3600, 3 * 3600)
+
+
+def percentiles(values):
+    values = np.array(values) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"mean": values.mean(), "p50": p50, "p95": p95, "p99": p99}
+
+
+# Look a track up the way the page does: search, then run the metadata, audio features
+# and waveform callbacks at once, as the browser requests them in parallel. Returns the
+# seconds until the metadata was shown (first content) and until everything was.
+def lookup(query, callbacks, render):
+    started = time.perf_counter()
+    track_uri = functions.get_track_uri(query)
+    metadata = callbacks.submit(functions.get_metadata, track_uri)
+    features = callbacks.submit(
+        lambda: functions.get_similar_tracks(functions.get_audio_features(track_uri))
+    )
+    waveform = callbacks.submit(functions.get_audio_analysis, track_uri, render=render)
+    metadata.result()
+    first_content = time.perf_counter() - started
+    features.result()
+    waveform.result()
+    return first_content, time.perf_counter() - started
+
+
+# Forget every cached response and waveform, so the next lookups go to the (fake) API.
+def clear_caches():
+    functions.api_cache.clear()
+    functions.waveform_cache.clear()
+    functions.search_results.clear()
+    functions.segment_store.clear()
+
+
+# Look up every query with `concurrency` users at once, returning the throughput and
+# latency percentiles (in milliseconds) of the lookups.
+def run_level(queries, concurrency, render):
+    with futures.ThreadPoolExecutor(concurrency * 3) as callbacks:
+        with futures.ThreadPoolExecutor(concurrency) as users:
+            started = time.perf_counter()
+            timings = list(users.map(lambda q: lookup(q, callbacks, render), queries))
+            elapsed = time.perf_counter() - started
+    first_content, total = zip(*timings)
+    return {
+        "lookups": len(queries),
+        "seconds": elapsed,
+        "throughput": len(queries) / elapsed,
+        "latency_ms": percentiles(total),
+        "first_content_ms": percentiles(first_content),
+    }
+
+
+# End-to-end lookups at every concurrency level, first with empty caches (every lookup
+# calls the API) and then again with the caches filled by the first pass.
+def end_to_end(queries, levels, render):
+    results = []
+    for concurrency in levels:
+        clear_caches()
+        for cache in ("cold", "warm"):
+            result = run_level(queries, concurrency, render)
+            results.append(dict(result, concurrency=concurrency, cache=cache))
+            print(
+                "{:>4} users {:>5}: {:>7.1f} lookups/s, p50 {:>8.1f} ms, "
+                "p95 {:>8.1f} ms".format(
+                    concurrency,
+                    cache,
+                    result["throughput"],
+                    result["latency_ms"]["p50"],
+                    result["latency_ms"]["p95"],
+                )
+            )
+    return results
+
+
+# Best time of a few runs of a function, in milliseconds.
+def best_ms(function, number):
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1000
+
+
+def binning():
+    results = []
+    for seconds in track_lengths:
+        audio_analysis = make_long_audio_analysis(seconds, seed=seconds)
+        segments = audio_analysis["segments"]
+        for aggregation in ("sample", "rms"):
+            ms = best_ms(
+                lambda: bin_levels(segments, seconds, aggregation=aggregation), 5
+            )
+            results.append(
+                {
+                    "track_seconds": seconds,
+                    "segments": len(segments),
+                    "aggregation": aggregation,
+                    "ms": ms,
+                }
+            )
+            print(
+                "binning {:>6} s ({:>6} segments, {:>6}): {:>8.2f} ms".format(
+                    seconds, len(segments), aggregation, ms
+                )
+            )
+    return results
+
+
+def size(rendered):
+    if isinstance(rendered, str):
+        return len(rendered.encode())
+    return len(json.dumps(rendered).encode())
+
+
+# Time rendering a three minute track, with its structure, in every render mode. A mode
+# that can't render here (png without Kaleido) is recorded with its error instead.
+def rendering():
+    audio_analysis = make_long_audio_analysis(180)
+    segments, duration = audio_analysis["segments"], audio_analysis["track"]["duration"]
+    index, levels = bin_levels(segments, duration)
+    structure = track_structure(audio_analysis, duration)
+    renders = {
+        mode: lambda mode=mode: functions.render_waveform(
+            index, levels, mode, structure
+        )
+        for mode in ("png", "svg", "graph")
+    }
+    renders["pyramid"] = lambda: encode_pyramid(
+        build_pyramid(segments, duration), duration, structure
+    )
+    results = []
+    for mode, render in renders.items():
+        try:
+            rendered = render()
+        except Exception as e:
+            error = "{}: {}".format(type(e).__name__, e).splitlines()[0]
+            results.append({"mode": mode, "error": error})
+            print("render {:>7}: failed ({})".format(mode, results[-1]["error"]))
+            continue
+        ms = best_ms(render, 5 if mode == "png" else 20)
+        results.append({"mode": mode, "ms": ms, "bytes": size(rendered)})
+        print("render {:>7}: {:>8.2f} ms, {:>8} bytes".format(mode, ms, size(rendered)))
+    return results
+
+
+def git(*args):
+    try:
+        return subprocess.run(
+            ["git"] + list(args), capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run(args):
+    delays = {endpoint: args.api_delay for endpoint in fixture_endpoints}
+    fixtures = load_fixtures(args.fixtures) if args.fixtures else None
+    if fixtures:
+        queries = list(fixtures.get("search", {}))
+    else:
+        queries = ["synthetic track {}".format(i) for i in range(args.tracks)]
+    fake = FakeSpotify(delays=delays, fixtures=fixtures).start()
+    functions.sp = PooledSpotify(
+        limiter=TokenBucket(rate=10000, burst=10000),
+        breaker=CircuitBreaker(threshold=1000, cooldown=30),
+        auth="benchmark",
+    )
+    functions.sp.prefix = fake.prefix
+    try:
+        levels = [int(level) for level in args.concurrency.split(",")]
+        results = {"end_to_end": end_to_end(queries, levels, args.render)}
+    finally:
+        fake.stop()
+    results["binning"] = binning()
+    results["render"] = rendering()
+    commit = git("rev-parse", "--short", "HEAD") or "unknown"
+    results["run"] = {
+        "commit": commit,
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "render": args.render,
+        "api_delay": args.api_delay,
+        "fixtures": args.fixtures,
+        "tracks": len(queries),
+    }
+    output = args.output or os.path.join("benchmarks", "results", commit + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Saved results to {}".format(output))
+
+
+# Save the API responses in a response cache as fixtures. Run the app once with real
+# credentials against a fresh SPOTIFY_CACHE_PATH and search for some tracks to fill it.
+def record(args):
+    store = ResponseCache(args.cache, offline=True)
+    fixtures = {endpoint: dict(store.items(endpoint)) for endpoint in fixture_endpoints}
+    with gzip.open(args.output, "wt") as f:
+        json.dump(fixtures, f, separators=(",", ":"))
+    print(
+        "Recorded {} to {}".format(
+            ", ".join(
+                "{} {}".format(len(responses), endpoint)
+                for endpoint, responses in fixtures.items()
+            ),
+            args.output,
+        )
+    )
+
+
+# Comparable measurements of a results file, as {name: (value, higher is better)}.
+def measurements(results):
+    values = {}
+    for r in results["end_to_end"]:
+        name = "{} users {}".format(r["concurrency"], r["cache"])
+        values[name + " throughput"] = (r["throughput"], True)
+        values[name + " p50 ms"] = (r["latency_ms"]["p50"], False)
+        values[name + " p95 ms"] = (r["latency_ms"]["p95"], False)
+    for r in results["binning"]:
+        name = "binning {} s {}".format(r["track_seconds"], r["aggregation"])
+        values[name + " ms"] = (r["ms"], False)
+    for r in results["render"]:
+        if "ms" in r:
+            values["render {} ms".format(r["mode"])] = (r["ms"], False)
+    return values
+
+
+# Print how every measurement changed between two results files and exit with status 1
+# if any got worse by more than the threshold.
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = measurements(json.load(f))
+    with open(args.candidate) as f:
+        candidate = measurements(json.load(f))
+    regressions = 0
+    for name, (before, higher_is_better) in baseline.items():
+        if name not in candidate:
+            continue
+        after = candidate[name][0]
+        change = (after - before) / before if before else 0
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(
+            "{:<36} {:>12.2f} {:>12.2f} {:>+8.1%}{}".format(
+                name, before, after, change, flag
+            )
+        )
+    if regressions:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay benchmarks against a local fake Spotify API."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument(
+        "--fixtures", help="recorded responses to replay (see the record command)"
+    )
+    run_parser.add_argument(
+        "--tracks",
+        type=int,
+        default=40,
+        help="synthetic tracks to look up without fixtures (default 40)",
+    )
+    run_parser.add_argument(
+        "--concurrency",
+        default="1,4,16",
+        help="comma separated numbers of simultaneous users (default 1,4,16)",
+    )
+    run_parser.add_argument(
+        "--api-delay",
+        type=float,
+        default=0.05,
+        help="seconds the fake API takes per request (default 0.05)",
+    )
+    run_parser.add_argument(
+        "--render",
+        default=functions.waveform_render,
+        help="waveform render mode of the end-to-end lookups (default svg)",
+    )
+    run_parser.add_argument(
+        "--output", help="results file (default benchmarks/results/<commit>.json)"
+    )
+    run_parser.set_defaults(handler=run)
+
+    record_parser = commands.add_parser(
+        "record", help="save a response cache as fixtures"
+    )
+    record_parser.add_argument("cache", help="SPOTIFY_CACHE_PATH of a recording run")
+    record_parser.add_argument("output", help="fixtures file to write (.json.gz)")
+    record_parser.set_defaults(handler=record)
+
+    compare_parser = commands.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative change counted as a regression (default 0.1)",
+    )
+    compare_parser.set_defaults(handler=compare)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
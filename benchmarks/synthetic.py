@@ -0,0 +1,94 @@
+import numpy as np
+
+
+# Build a fake audio analysis with the given number of back-to-back segments.
+# Segment durations and loudness follow the rough shape of real Spotify analyses
+# (a few hundred milliseconds per segment, loudness_max mostly between -40 and 0 dB).
+def make_audio_analysis(segment_count, seed=0):
+    rng = np.random.default_rng(seed)
+    durations = rng.uniform(0.05, 0.5, size=segment_count)
+    starts = np.concatenate(([0.0], np.cumsum(durations)[:-1]))
+    loudness = np.clip(rng.normal(-12, 8, size=segment_count), -60, 0)
+    segments = [
+        {
+            "start": float(start),
+            "duration": float(duration),
+            "confidence": 1.0,
+            "loudness_start": float(level) - 10,
+            "loudness_max_time": float(duration) / 2,
+            "loudness_max": float(level),
+            "pitches": [0.5] * 12,
+            "timbre": [0.0] * 12,
+        }
+        for start, duration, level in zip(starts, durations, loudness)
+    ]
+    duration = float(durations.sum())
+    return dict(
+        make_rhythm(duration, rng),
+        track={"duration": duration},
+        segments=segments,
+    )
+
+
+# Evenly spaced intervals covering [0, duration), the way beats and bars are listed.
+def make_intervals(duration, length, confidence=0.5):
+    starts = np.arange(0, duration, length)
+    return [
+        {
+            "start": float(start),
+            "duration": float(min(length, duration - start)),
+            "confidence": confidence,
+        }
+        for start in starts
+    ]
+
+
+# Bars, beats, tatums and sections for a track in 4/4 at a steady random tempo, with
+# sections of 15 to 45 seconds.
+def make_rhythm(duration, rng):
+    tempo = float(rng.uniform(80, 160))
+    beat = 60 / tempo
+    lengths = rng.uniform(15, 45, size=int(duration / 15) + 1)
+    starts = np.concatenate(([0.0], np.cumsum(lengths)))
+    starts = starts[starts < duration]
+    ends = np.append(starts[1:], duration)
+    sections = [
+        dict(
+            start=float(start),
+            duration=float(end - start),
+            confidence=0.5,
+            loudness=float(rng.uniform(-20, -4)),
+            tempo=tempo,
+            key=int(rng.integers(12)),
+            mode=int(rng.integers(2)),
+            time_signature=4,
+        )
+        for start, end in zip(starts, ends)
+    ]
+    return {
+        "bars": make_intervals(duration, beat * 4),
+        "beats": make_intervals(duration, beat),
+        "tatums": make_intervals(duration, beat / 2),
+        "sections": sections,
+    }
+
+
+# Build a fake audio analysis of a track lasting `seconds`, such as a multi-hour DJ mix or
+# podcast, with as many segments as it takes to cover it.
+def make_long_audio_analysis(seconds, seed=0):
+    # segments last 0.275 s on average
+    count = int(seconds / 0.275 * 1.05) + 16
+    audio_analysis = make_audio_analysis(count, seed=seed)
+    while audio_analysis["track"]["duration"] < seconds:
+        count *= 2
+        audio_analysis = make_audio_analysis(count, seed=seed)
+    trimmed = {"track": {"duration": float(seconds)}}
+    for table in ("segments", "bars", "beats", "tatums", "sections"):
+        rows = [row for row in audio_analysis[table] if row["start"] < seconds]
+        rows[-1]["duration"] = min(rows[-1]["duration"], seconds - rows[-1]["start"])
+        trimmed[table] = rows
+    last = trimmed["segments"][-1]
+    last["duration"] = seconds - last["start"]
+    last["loudness_max_time"] = last["duration"] / 2
+    trimmed["sections"][-1]["duration"] = seconds - trimmed["sections"][-1]["start"]
+    return trimmed
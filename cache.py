@@ -0,0 +1,329 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+
+# How long (in seconds) a cached response stays fresh, per Spotify API endpoint.
+# Search results change as the catalog changes, the rest only change on re-releases.
+default_ttls = {
+    "search": 24 * 60 * 60,
+    "track": 7 * 24 * 60 * 60,
+    "audio_features": 30 * 24 * 60 * 60,
+    "audio_analysis": 30 * 24 * 60 * 60,
+    "waveform": 30 * 24 * 60 * 60,
+    "waveform_asset": 30 * 24 * 60 * 60,
+    "token": 60 * 60,
+}
+
+# Bump when the way waveforms are drawn changes, so previously rendered artifacts are
+# no longer served.
+artifact_version = 2
+
+
+# Raised in offline mode when a response is not in the cache.
+class CacheMiss(KeyError):
+    pass
+
+
+# A cache of Spotify API responses stored as compressed JSON in a SQLite database.
+# The database file can be shared by every gunicorn worker on the host. Entries expire
+# after the TTL of their endpoint and the least recently used entries are evicted once
+# the total size passes max_bytes. Hit and miss counts are kept in the database, so they
+# cover all workers.
+# In offline mode the cache acts as a recorded fixture store: entries never expire and a
+# miss raises CacheMiss instead of calling the API.
+class ResponseCache:
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, ttls=None, offline=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = dict(default_ttls, **(ttls or {}))
+        self.offline = offline
+        self.local = threading.local()
+        self.connect().executescript(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                endpoint TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                stored REAL NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (endpoint, key)
+            );
+            CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+            CREATE TABLE IF NOT EXISTS counters (
+                endpoint TEXT PRIMARY KEY,
+                hits INTEGER NOT NULL DEFAULT 0,
+                misses INTEGER NOT NULL DEFAULT 0
+            );
+            """
+        )
+
+    # SQLite connections can't be shared between threads or across a fork, so each thread
+    # of each process gets its own.
+    def connect(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def count(self, endpoint, column):
+        self.connect().execute(
+            "INSERT INTO counters (endpoint, {0}) VALUES (?, 1) "
+            "ON CONFLICT (endpoint) DO UPDATE SET {0} = {0} + 1".format(column),
+            (endpoint,),
+        )
+
+    # Return the cached response for a key, raising CacheMiss if there is no fresh entry.
+    def get(self, endpoint, key):
+        connection = self.connect()
+        row = connection.execute(
+            "SELECT value, stored FROM responses WHERE endpoint = ? AND key = ?",
+            (endpoint, key),
+        ).fetchone()
+        now = time.time()
+        if row is None or (
+            not self.offline and now - row[1] > self.ttls.get(endpoint, 0)
+        ):
+            self.count(endpoint, "misses")
+            raise CacheMiss((endpoint, key))
+        connection.execute(
+            "UPDATE responses SET accessed = ? WHERE endpoint = ? AND key = ?",
+            (now, endpoint, key),
+        )
+        self.count(endpoint, "hits")
+        return json.loads(zlib.decompress(row[0]))
+
+    def set(self, endpoint, key, value):
+        blob = zlib.compress(json.dumps(value, separators=(",", ":")).encode())
+        now = time.time()
+        connection = self.connect()
+        connection.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+            (endpoint, key, blob, len(blob), now, now),
+        )
+        self.evict()
+
+    # Drop the least recently used entries until the cache is back under 90% of max_bytes.
+    def evict(self):
+        connection = self.connect()
+        total = connection.execute("SELECT TOTAL(size) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        rows = connection.execute(
+            "SELECT endpoint, key, size FROM responses ORDER BY accessed"
+        )
+        stale = []
+        for endpoint, key, size in rows:
+            if total <= target:
+                break
+            stale.append((endpoint, key))
+            total -= size
+        rows.close()
+        connection.executemany(
+            "DELETE FROM responses WHERE endpoint = ? AND key = ?", stale
+        )
+
+    # Whether there is a fresh entry for a key, without counting a hit or a miss or marking
+    # the entry as used.
+    def contains(self, endpoint, key):
+        connection = self.connect()
+        row = connection.execute(
+            "SELECT stored FROM responses WHERE endpoint = ? AND key = ?",
+            (endpoint, key),
+        ).fetchone()
+        if row is None:
+            return False
+        return self.offline or time.time() - row[0] <= self.ttls.get(endpoint, 0)
+
+    # Return the cached response for a key, calling fetch and storing its result on a miss.
+    def cached(self, endpoint, key, fetch):
+        try:
+            return self.get(endpoint, key)
+        except CacheMiss:
+            if self.offline:
+                raise
+        value = fetch()
+        self.set(endpoint, key, value)
+        return value
+
+    # Return the cached responses for several keys. The keys that miss are passed to
+    # fetch in one call, which must return their responses in the same order.
+    def cached_many(self, endpoint, keys, fetch):
+        values = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            try:
+                values[key] = self.get(endpoint, key)
+            except CacheMiss:
+                if self.offline:
+                    raise
+                missing.append(key)
+        if missing:
+            for key, value in zip(missing, fetch(missing)):
+                self.set(endpoint, key, value)
+                values[key] = value
+        return [values[key] for key in keys]
+
+    # Every cached key and response of an endpoint, most recently used first.
+    def items(self, endpoint, limit=-1):
+        rows = self.connect().execute(
+            "SELECT key, value FROM responses WHERE endpoint = ? "
+            "ORDER BY accessed DESC LIMIT ?",
+            (endpoint, limit),
+        )
+        for key, value in rows:
+            yield key, json.loads(zlib.decompress(value))
+
+    # Hit and miss counts per endpoint, plus the number and total size of cached entries.
+    def stats(self):
+        connection = self.connect()
+        counters = {
+            endpoint: {"hits": hits, "misses": misses}
+            for endpoint, hits, misses in connection.execute(
+                "SELECT endpoint, hits, misses FROM counters"
+            )
+        }
+        entries, size = connection.execute(
+            "SELECT COUNT(*), TOTAL(size) FROM responses"
+        ).fetchone()
+        return {"endpoints": counters, "entries": entries, "bytes": int(size)}
+
+    def clear(self):
+        connection = self.connect()
+        connection.execute("DELETE FROM responses")
+        connection.execute("DELETE FROM counters")
+
+
+# A small in-process LRU cache bounded by its number of entries.
+class LRUCache:
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Return the value for a key, or None if it isn't cached.
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Content address of a rendered artifact: a hash of everything the artifact depends on.
+def artifact_key(track_uri, **params):
+    spec = json.dumps(
+        dict(params, uri=track_uri, version=artifact_version), sort_keys=True
+    )
+    return hashlib.sha256(spec.encode()).hexdigest()
+
+
+# A two-tier cache of finished artifacts (rendered waveforms) keyed by artifact_key.
+# The first tier is an in-process LRU bounded by max_bytes, the second the shared
+# on-disk ResponseCache, so a track rendered by one worker is served by every worker.
+# Artifacts must be JSON serializable (data URI strings or figure dicts).
+class ArtifactCache:
+    def __init__(self, store, endpoint="waveform", max_bytes=32 * 1024 * 1024):
+        self.store = store
+        self.endpoint = endpoint
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def remember(self, key, value):
+        size = len(value) if isinstance(value, str) else len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1][1]
+
+    # Return the artifact for a key, falling back to the disk tier and then to render.
+    # Artifacts are rendered locally, so they are rendered on a miss even in offline mode.
+    def cached(self, key, render):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        try:
+            value = self.store.get(self.endpoint, key)
+        except CacheMiss:
+            value = render()
+            self.store.set(self.endpoint, key, value)
+        self.remember(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
+
+
+# Build the response cache from environment variables.
+# SPOTIFY_CACHE_PATH sets the database file (shared by all workers on the host),
+# SPOTIFY_CACHE_MAX_MB its size cap and SPOTIFY_CACHE_OFFLINE=1 replays it as a
+# fixture store without calling the API.
+def cache_from_environment():
+    return ResponseCache(
+        path=os.environ.get(
+            "SPOTIFY_CACHE_PATH",
+            os.path.join(tempfile.gettempdir(), "spotify-data-visualizer.sqlite"),
+        ),
+        max_bytes=int(
+            float(os.environ.get("SPOTIFY_CACHE_MAX_MB", "256")) * 1024 * 1024
+        ),
+        offline=os.environ.get("SPOTIFY_CACHE_OFFLINE", "") == "1",
+    )
+
+
+# Build the rendered waveform cache on top of a response cache.
+# WAVEFORM_CACHE_MAX_MB sets the memory budget of the in-process tier.
+def waveform_cache_from_environment(store):
+    return ArtifactCache(
+        store,
+        max_bytes=int(
+            float(os.environ.get("WAVEFORM_CACHE_MAX_MB", "32")) * 1024 * 1024
+        ),
+    )
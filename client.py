@@ -0,0 +1,237 @@
+import os
+import threading
+import time
+from concurrent import futures
+import requests
+import spotipy
+from requests.adapters import HTTPAdapter
+from spotipy.cache_handler import CacheHandler
+from spotipy.exceptions import SpotifyException
+from spotipy.oauth2 import SpotifyClientCredentials
+
+
+# Raised instead of calling the API while the circuit breaker is open.
+class CircuitOpen(SpotifyException):
+    def __init__(self, retry_in):
+        super().__init__(
+            503, -1, "Spotify API circuit open, retry in {:.1f}s".format(retry_in)
+        )
+
+
+# Keeps the client credentials access token in the shared response cache, so all workers
+# reuse one token instead of each requesting their own.
+class SharedTokenCache(CacheHandler):
+    def __init__(self, store):
+        self.store = store
+
+    def get_cached_token(self):
+        try:
+            return self.store.get("token", "client_credentials")
+        except KeyError:
+            return None
+
+    def save_token_to_cache(self, token_info):
+        self.store.set("token", "client_credentials", token_info)
+
+
+# Raised instead of calling the API once a RequestBudget has been spent.
+class BudgetExhausted(Exception):
+    pass
+
+
+# Allows at most `total` requests in all, each also waiting for another limiter (such as a
+# TokenBucket). For background jobs, so they stop before using up the API rate limit.
+class RequestBudget:
+    def __init__(self, limiter, total):
+        self.limiter = limiter
+        self.total = total
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.used >= self.total:
+                raise BudgetExhausted(
+                    "Spent the budget of {} requests".format(self.total)
+                )
+            self.used += 1
+        self.limiter.acquire()
+
+    def pause(self, seconds):
+        self.limiter.pause(seconds)
+
+
+# A token bucket allowing `rate` requests per second on average, in bursts of up to
+# `burst`. A Retry-After from the API pauses every caller until it has passed.
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # Block until a request may be made.
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# Stops calling the API after `threshold` failures in a row, failing fast with CircuitOpen
+# for `cooldown` seconds. After the cooldown one trial request is let through: if it
+# succeeds the circuit closes, if not it stays open for another cooldown.
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def check(self):
+        with self.lock:
+            if self.opened is None:
+                return
+            waited = time.monotonic() - self.opened
+            if waited < self.cooldown or self.trial:
+                raise CircuitOpen(max(0, self.cooldown - waited))
+            self.trial = True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened = time.monotonic()
+            self.trial = False
+
+    # End a trial request that neither succeeded nor failed (such as one that never got
+    # to the API), so the next one can be let through.
+    def release(self):
+        with self.lock:
+            self.trial = False
+
+
+# A spotipy client for use by many threads at once. It keeps a pool of keep-alive
+# connections, waits for a token bucket before every request, and retries rate limited
+# (429) requests after their Retry-After and server errors with exponential backoff. A
+# circuit breaker stops calls while the API keeps failing. Concurrent GET requests for
+# the same URL (such as the same track from two visitors) share one in-flight request.
+class PooledSpotify(spotipy.Spotify):
+    def __init__(
+        self,
+        limiter,
+        breaker,
+        max_attempts=4,
+        pool_size=16,
+        requests_timeout=10,
+        **kwargs
+    ):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        super().__init__(
+            requests_session=session, requests_timeout=requests_timeout, **kwargs
+        )
+        self.limiter = limiter
+        self.breaker = breaker
+        self.max_attempts = max_attempts
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+
+    def _internal_call(self, method, url, payload, params):
+        if method != "GET":
+            return self.call_with_retry(method, url, payload, params)
+        key = (url, repr(sorted((params or {}).items())))
+        with self.in_flight_lock:
+            shared = self.in_flight.get(key)
+            if shared is None:
+                shared = self.in_flight[key] = futures.Future()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            return shared.result()
+        try:
+            result = self.call_with_retry(method, url, payload, params)
+            shared.set_result(result)
+            return result
+        except BaseException as e:
+            shared.set_exception(e)
+            raise
+        finally:
+            with self.in_flight_lock:
+                del self.in_flight[key]
+
+    def call_with_retry(self, method, url, payload, params):
+        for attempt in range(self.max_attempts):
+            self.breaker.check()
+            try:
+                self.limiter.acquire()
+                result = super()._internal_call(
+                    method, url, payload, dict(params or {})
+                )
+            except SpotifyException as e:
+                if e.http_status >= 500:
+                    self.breaker.failed()
+                    backoff = 0.1 * 2**attempt
+                else:
+                    # the API answered, so it's up even if it refused the request
+                    self.breaker.succeeded()
+                    if e.http_status != 429:
+                        raise
+                    retry_after = (e.headers or {}).get("Retry-After")
+                    self.limiter.pause(float(retry_after) if retry_after else 1)
+                    backoff = 0
+                if attempt == self.max_attempts - 1:
+                    raise
+            except requests.exceptions.RequestException:
+                self.breaker.failed()
+                if attempt == self.max_attempts - 1:
+                    raise
+                backoff = 0.1 * 2**attempt
+            else:
+                self.breaker.succeeded()
+                return result
+            finally:
+                self.breaker.release()
+            time.sleep(backoff)
+
+
+# Build the Spotify client from environment variables, sharing its access token through
+# the response cache. SPOTIFY_RATE_LIMIT sets the requests per second each worker may make
+# (default 10).
+def client_from_environment(store):
+    credentials = SpotifyClientCredentials(
+        client_id=os.environ.get("SPOTIPY_CLIENT_ID"),
+        client_secret=os.environ.get("SPOTIPY_CLIENT_SECRET"),
+        cache_handler=SharedTokenCache(store),
+    )
+    rate = float(os.environ.get("SPOTIFY_RATE_LIMIT", "10"))
+    return PooledSpotify(
+        limiter=TokenBucket(rate=rate, burst=max(1, rate)),
+        breaker=CircuitBreaker(threshold=5, cooldown=30),
+        client_credentials_manager=credentials,
+    )
@@ -0,0 +1,239 @@
+import os
+import tempfile
+import threading
+import numpy as np
+from feature_store import feature_names, truncate_utf8
+from similar import normalize
+
+
+# Resolution of the feature histograms: each feature's range (see similar.feature_ranges)
+# is split into this many equal bins, so percentile ranks are exact to within a bin.
+histogram_bins = 1000
+
+# Artists need at least this many tracks for a rank among their tracks to be shown.
+min_artist_tracks = 5
+
+
+# Histogram bin of each raw feature value, in a matrix of features. Missing values get
+# bin 0 and have to be masked by the caller.
+def histogram_bin(features):
+    scaled = np.nan_to_num(normalize(features))
+    return np.minimum((scaled * histogram_bins).astype(int), histogram_bins - 1)
+
+
+# Artists are compared as they are stored in the feature store: truncated UTF-8.
+def encode_artist(artist):
+    return truncate_utf8(artist or "", 64)
+
+
+# The distribution of every audio feature across all tracks seen, overall and per artist,
+# for ranking a track's features against them.
+# Overall, each feature is kept as a fixed-bin histogram: histograms of different stores
+# or workers merge by adding their counts, new tracks update them in place, and a rank is
+# a lookup in the running totals of the counts.
+# Per artist, build() keeps every track's features sorted within its artist's block of an
+# array sorted by artist, so an artist is found with a binary search and a rank within
+# its block with another. Tracks added after the build are kept aside per artist until
+# the next build.
+class FeatureDistributions:
+    def __init__(self):
+        self.counts = np.zeros((len(feature_names), histogram_bins), dtype=np.int64)
+        self.cumulative = None
+        self.artists = np.zeros(0, dtype="S64")
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.values = np.zeros((len(feature_names), 0), dtype="f4")
+        self.recent = {}
+        self.synced = 0
+        self.uris = np.zeros(0, dtype="S40")
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+
+    def __len__(self):
+        return int(self.counts[0].sum())
+
+    # Add tracks given their artists, encoded as in the feature store (see encode_artist),
+    # and a matrix of their raw audio features. Features that are missing (NaN) are left
+    # out of their distribution.
+    def add(self, artists, features):
+        features = np.atleast_2d(np.asarray(features, dtype="f4"))
+        bins = histogram_bin(features)
+        present = ~np.isnan(features)
+        # group the rows by artist, to keep them aside one block per artist
+        artists = np.asarray(artists, dtype="S64")
+        order = np.argsort(artists, kind="stable")
+        artists = artists[order]
+        starts = np.flatnonzero(np.r_[True, artists[1:] != artists[:-1]])
+        blocks = np.split(features[order], starts[1:])
+        with self.lock:
+            for column in range(len(feature_names)):
+                self.counts[column] += np.bincount(
+                    bins[present[:, column], column], minlength=histogram_bins
+                )
+            self.cumulative = None
+            for artist, block in zip(artists[starts], blocks):
+                self.recent.setdefault(artist, []).append(block)
+
+    # Catch up with rows appended to a FeatureStore since the last sync or build. Every
+    # worker appends the tracks it looks up, so a track can have several rows; only the
+    # first row of a track is counted, as build() counts only the newest. Syncs run one
+    # at a time, so rows are never counted twice by threads syncing at once.
+    def sync(self, store):
+        with self.sync_lock:
+            total = len(store)
+            if total <= self.synced:
+                return
+            rows = store.read()[self.synced : total]
+            first = np.sort(np.unique(rows["uri"], return_index=True)[1])
+            rows = rows[first]
+            rows = rows[~np.isin(rows["uri"], self.uris)]
+            if len(rows):
+                features = np.stack([rows[name] for name in feature_names], axis=1)
+                self.add(rows["artist"], features)
+            self.uris = np.concatenate([self.uris, rows["uri"]])
+            self.synced = total
+
+    # Rebuild the distributions from the newest row of every track in a FeatureStore.
+    def build(self, store):
+        with self.sync_lock:
+            total = len(store)
+            rows = store.latest()
+            features = np.stack([rows[name] for name in feature_names], axis=1)
+            counts = np.zeros_like(self.counts)
+            bins = histogram_bin(features)
+            for column in range(len(feature_names)):
+                present = ~np.isnan(features[:, column])
+                counts[column] = np.bincount(
+                    bins[present, column], minlength=histogram_bins
+                )
+            # sort by artist, then by value within each artist (NaNs last), per feature
+            order = np.argsort(rows["artist"], kind="stable")
+            artists = rows["artist"][order]
+            starts = np.flatnonzero(np.r_[True, artists[1:] != artists[:-1]])
+            values = np.empty((len(feature_names), len(rows)), dtype="f4")
+            for column in range(len(feature_names)):
+                column_values = features[order, column]
+                values[column] = column_values[np.lexsort((column_values, artists))]
+            with self.lock:
+                self.counts = counts
+                self.cumulative = None
+                self.artists = artists[starts] if len(rows) else self.artists[:0]
+                self.offsets = np.append(starts, len(rows))
+                self.values = values
+                self.recent = {}
+                self.synced = total
+                self.uris = rows["uri"]
+
+    # Percentile (0 to 100) of a raw feature value among all tracks: the share of tracks
+    # with a lower value, counting tracks in the same bin as half below.
+    def rank(self, name, value):
+        column = feature_names.index(name)
+        with self.lock:
+            if self.cumulative is None:
+                self.cumulative = np.cumsum(self.counts, axis=1)
+            cumulative = self.cumulative[column]
+        total = cumulative[-1]
+        if total == 0 or value is None or np.isnan(value):
+            return None
+        features = np.full(len(feature_names), np.nan, dtype="f4")
+        features[column] = value
+        b = histogram_bin(features)[column]
+        below = cumulative[b - 1] if b > 0 else 0
+        return 100 * (below + (cumulative[b] - below) / 2) / total
+
+    # Percentile of a raw feature value among the tracks of an artist, or None if the
+    # artist has fewer than min_artist_tracks tracks with that feature.
+    def artist_rank(self, artist, name, value):
+        if value is None or np.isnan(value):
+            return None
+        column = feature_names.index(name)
+        key = encode_artist(artist)
+        with self.lock:
+            i = np.searchsorted(self.artists, key)
+            if i < len(self.artists) and self.artists[i] == key:
+                block = self.values[column, self.offsets[i] : self.offsets[i + 1]]
+                block = block[: np.searchsorted(block, np.inf, side="right")]
+            else:
+                block = self.values[column, :0]
+            recent = np.concatenate(
+                [block[:, column] for block in self.recent.get(key, [])]
+                + [self.values[column, :0]]
+            )
+        recent = recent[~np.isnan(recent)]
+        total = len(block) + len(recent)
+        if total < min_artist_tracks:
+            return None
+        below = np.searchsorted(block, value, side="left") + (recent < value).sum()
+        equal = np.searchsorted(block, value, side="right") - np.searchsorted(
+            block, value, side="left"
+        )
+        equal += (recent == value).sum()
+        return 100 * (below + equal / 2) / total
+
+    # Save the distributions to a .npz file, replacing the old file atomically.
+    def save(self, path):
+        with self.lock:
+            directory = os.path.dirname(os.path.abspath(path))
+            with tempfile.NamedTemporaryFile(
+                dir=directory, suffix=".npz", delete=False
+            ) as f:
+                np.savez(
+                    f,
+                    counts=self.counts,
+                    artists=self.artists,
+                    offsets=self.offsets,
+                    values=self.values,
+                    synced=self.synced,
+                    uris=self.uris,
+                )
+            os.replace(f.name, path)
+
+    @classmethod
+    def load(cls, path):
+        distributions = cls()
+        with np.load(path) as data:
+            distributions.counts = data["counts"]
+            distributions.artists = data["artists"]
+            distributions.offsets = data["offsets"]
+            distributions.values = data["values"]
+            distributions.synced = int(data["synced"])
+            if "uris" in data:
+                distributions.uris = data["uris"]
+        return distributions
+
+
+def distributions_path():
+    return os.environ.get(
+        "DISTRIBUTIONS_PATH",
+        os.path.join(
+            tempfile.gettempdir(), "spotify-data-visualizer.distributions.npz"
+        ),
+    )
+
+
+# Load the feature distributions from DISTRIBUTIONS_PATH if they have been saved there,
+# else start empty; either way they catch up with the feature store when synced.
+def distributions_from_environment():
+    path = distributions_path()
+    if os.path.exists(path):
+        return FeatureDistributions.load(path)
+    return FeatureDistributions()
+
+
+# Rebuild the distributions from every track in the feature store and save them to
+# DISTRIBUTIONS_PATH. Run periodically (say nightly) so the per-artist ranks include the
+# tracks workers have added since, and so workers start from a saved build.
+def main():
+    from feature_store import feature_store_from_environment
+
+    distributions = FeatureDistributions()
+    distributions.build(feature_store_from_environment())
+    distributions.save(distributions_path())
+    print(
+        "Built distributions of {} tracks by {} artists in {}".format(
+            len(distributions), len(distributions.artists), distributions_path()
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
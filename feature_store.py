@@ -0,0 +1,161 @@
+import os
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass
+import numpy as np
+from numpy.lib import recfunctions
+
+
+# The audio features shown for a track, in the order of the cards in the app.
+feature_names = (
+    "danceability",
+    "valence",
+    "energy",
+    "tempo",
+    "loudness",
+    "speechiness",
+    "instrumentalness",
+    "liveness",
+    "acousticness",
+)
+
+
+# The metadata and audio features of one track.
+# Feature values are None for tracks the API has no audio features for.
+@dataclass
+class TrackRecord:
+    __slots__ = ("uri", "name", "artist", "album", "image", "preview_url")
+    __slots__ += feature_names
+    uri: str
+    name: str
+    artist: str
+    album: str
+    image: str
+    preview_url: str
+    danceability: float
+    valence: float
+    energy: float
+    tempo: float
+    loudness: float
+    speechiness: float
+    instrumentalness: float
+    liveness: float
+    acousticness: float
+
+    # Build a record from the responses of the track and audio features endpoints.
+    @classmethod
+    def from_api(cls, track_uri, metadata, audio_features):
+        audio_features = audio_features or {}
+        images = metadata["album"]["images"]
+        return cls(
+            track_uri,
+            metadata["name"],
+            metadata["album"]["artists"][0]["name"],
+            metadata["album"]["name"],
+            images[min(1, len(images) - 1)]["url"] if images else None,
+            metadata["preview_url"],
+            *(audio_features.get(name) for name in feature_names),
+        )
+
+    def features(self):
+        return [getattr(self, name) for name in feature_names]
+
+    def to_dict(self):
+        return asdict(self)
+
+
+# Layout of one row of the feature store. Text is stored as fixed-width UTF-8, so rows
+# have a fixed size and the file can be memory mapped as a structured array; artist
+# names longer than the field are truncated. Missing features are stored as NaN.
+record_dtype = np.dtype(
+    [("uri", "S40"), ("artist", "S64")]
+    + [(name, "f4") for name in feature_names]
+    + [("fetched", "f8")]
+)
+
+
+# Encode text as UTF-8 of at most `size` bytes, cut on a character boundary.
+def truncate_utf8(text, size):
+    return text.encode()[:size].decode("utf-8", "ignore").encode()
+
+
+# An append-only store of every track's audio features, kept in one binary file of
+# fixed-size rows. Each row is written with a single append, so several gunicorn workers
+# can add to the same file without their rows interleaving. Reading memory maps the whole
+# file as a NumPy structured array, so a column of millions of tracks is scanned without
+# parsing rows one by one. The rows are stored whole, though, so scanning one column
+# still reads every page of the file; separate column files would avoid that, but a row
+# could then no longer be appended atomically.
+# A track looked up more than once may have several rows; latest() keeps the newest.
+class FeatureStore:
+    def __init__(self, path):
+        self.path = path
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    # Append a TrackRecord. Records already appended by this process are skipped.
+    def append(self, record):
+        with self.lock:
+            if record.uri in self.seen:
+                return
+            self.seen.add(record.uri)
+        self.extend([record])
+
+    def extend(self, records):
+        rows = np.zeros(len(records), dtype=record_dtype)
+        now = time.time()
+        for row, record in zip(rows, records):
+            row["uri"] = record.uri.encode()
+            row["artist"] = truncate_utf8(record.artist or "", 64)
+            for name in feature_names:
+                value = getattr(record, name)
+                row[name] = np.nan if value is None else value
+            row["fetched"] = now
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, rows.tobytes())
+        finally:
+            os.close(fd)
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // record_dtype.itemsize
+
+    # Memory map every row in the store as a read-only structured array.
+    def read(self):
+        count = len(self)
+        if count == 0:
+            return np.zeros(0, dtype=record_dtype)
+        return np.memmap(self.path, dtype=record_dtype, mode="r", shape=(count,))
+
+    # The newest row of every track, as a structured array sorted by URI.
+    def latest(self):
+        rows = self.read()
+        if len(rows) == 0:
+            return np.array(rows)
+        # unique keeps the first occurrence, so search the rows newest first
+        newest_first = rows[::-1]
+        first = np.unique(newest_first["uri"], return_index=True)[1]
+        return np.array(newest_first[first])
+
+    def column(self, name):
+        return self.latest()[name]
+
+    # The features of the newest row of every track as a (tracks, features) float32 matrix.
+    def matrix(self):
+        rows = self.latest()
+        return recfunctions.structured_to_unstructured(
+            rows[list(feature_names)], dtype="f4"
+        )
+
+
+# Build the feature store from the FEATURE_STORE_PATH environment variable.
+def feature_store_from_environment():
+    return FeatureStore(
+        os.environ.get(
+            "FEATURE_STORE_PATH",
+            os.path.join(tempfile.gettempdir(), "spotify-data-visualizer.features"),
+        )
+    )
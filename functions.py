@@ -1,10 +1,36 @@
 import os
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+import hashlib
+import json
+import fcntl
+import logging
+import threading
+import time
+from concurrent import futures
 import numpy as np
-import pandas as pd
-import plotly.graph_objects as go
-from base64 import b64encode
+from base64 import b64decode, b64encode
+from spotipy.exceptions import SpotifyException
+from waveform import (
+    bin_levels,
+    build_pyramid,
+    encode_pyramid,
+    levels_svg,
+    render_modes,
+    track_structure,
+)
+from feature_store import TrackRecord, feature_names, feature_store_from_environment
+from similar import normalize, similar_index_from_environment
+from distributions import distributions_from_environment
+from metrics import CollectedCounter, payload_bytes, registry, stage_seconds
+from suggest import PrefixIndex, normalize_query, suggestions_path
+from client import client_from_environment
+from segments import segment_store_from_environment
+from cache import (
+    CacheMiss,
+    LRUCache,
+    artifact_key,
+    cache_from_environment,
+    waveform_cache_from_environment,
+)
 
 
 colors = {
@@ -14,106 +40,257 @@ colors = {
     "pink": "#e246ab",
 }
 
+# Colors of the tracks in a comparison, in order.
+compare_colors = [
+    "#e246ab",
+    "#1db954",
+    "#509bf5",
+    "#f59b23",
+    "#ffffff",
+    "#af2896",
+    "#27856a",
+    "#e8115b",
+    "#8d67ab",
+    "#b49bc8",
+]
+# Most tracks that can be compared at once.
+compare_limit = len(compare_colors)
 
-# Client ID and secret needed to access the Spotify API (client credentials flow).
-c_id = os.environ.get("SPOTIPY_CLIENT_ID")
-c_secret = os.environ.get("SPOTIPY_CLIENT_SECRET")
-c_credentials_manager = SpotifyClientCredentials(client_id=c_id, client_secret=c_secret)
-sp = spotipy.Spotify(client_credentials_manager=c_credentials_manager)
+
+# Responses from the Spotify API are cached on disk and shared by all workers.
+api_cache = cache_from_environment()
+# Client for the Spotify API (client credentials flow), see client.PooledSpotify.
+# The client ID and secret are read from SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET.
+sp = client_from_environment(api_cache)
+# Track URIs found by recent searches, by normalized query.
+search_results = LRUCache(max_entries=4096)
+# Suggestions for the search box, see get_suggestions.
+suggestions = PrefixIndex()
+suggestions_refreshed = 0
+suggestions_lock = threading.Lock()
+# Seconds before the saved suggestions are rebuilt from the response cache.
+suggestions_max_age = 60 * 60
+# The segments of audio analyses, kept in a compact binary format (see segments.py).
+segment_store = segment_store_from_environment()
+# Rendered waveforms are cached too, in memory first and then on disk.
+waveform_cache = waveform_cache_from_environment(api_cache)
+# Every track looked up is added to the feature store for later analytics.
+feature_store = feature_store_from_environment()
+# Index of those tracks by their audio features, for finding similar tracks.
+# Loaded on first use, see get_similar_index.
+similar_index = None
+similar_index_lock = threading.Lock()
+# Distributions of their audio features, for ranking a track's features against them.
+# Loaded on first use, see get_distributions.
+distributions = None
+distributions_lock = threading.Lock()
+
+
+# Cache hit ratios. The response cache counts for every worker on the host, the in-process
+# tier of the waveform cache for this worker only.
+registry.register(
+    CollectedCounter(
+        "response_cache_requests_total",
+        "Lookups in the shared Spotify API response cache, by endpoint and result.",
+        lambda: [
+            ({"endpoint": endpoint, "result": result}, counts[key])
+            for endpoint, counts in sorted(api_cache.stats()["endpoints"].items())
+            for result, key in (("hit", "hits"), ("miss", "misses"))
+        ],
+        per_process=False,
+    )
+)
+registry.register(
+    CollectedCounter(
+        "waveform_memory_cache_requests_total",
+        "Lookups in this worker's in-memory cache of rendered waveforms, by result.",
+        lambda: [
+            ({"result": result}, waveform_cache.stats()[key])
+            for result, key in (("hit", "hits"), ("miss", "misses"))
+        ],
+    )
+)
+
+
+# Most IDs the Spotify API accepts in one request, per batch endpoint.
+# Rate limiting and retries are handled by the client (see client.PooledSpotify).
+tracks_limit = 50
+audio_features_limit = 100
+
+# Concurrent API calls: the size of the thread pool they run on and how long (in seconds)
+# each one may take.
+fetch_threads = int(os.environ.get("SPOTIFY_FETCH_THREADS", "8"))
+fetch_timeout = float(os.environ.get("SPOTIFY_FETCH_TIMEOUT", "15"))
+pool = None
+pool_pid = None
+
+# How waveforms are rendered, set per deployment: "png" (default), "svg", "graph" or
+# "pyramid".
+waveform_render = os.environ.get("WAVEFORM_RENDER", "png")
+if waveform_render not in render_modes:
+    raise ValueError("Unknown waveform render mode: {}".format(waveform_render))
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
 
 
 # Search for a track and return its Spotify URI.
 # Returns None if the query is empty or if there are no results found for the query.
+# Queries are cached by their normalized form, so ones that differ only in case, accents or
+# spacing share a result. Found tracks become suggestions.
 def get_track_uri(query):
-    if query == "":
+    normalized = normalize_query(query or "")
+    if normalized == "":
         return None
-    results = sp.search(q=query, type="track")
+    uri = search_results.get(normalized)
+    if uri is not None:
+        return uri
+    with stage_seconds.time(stage="search"):
+        results = api_cache.cached(
+            "search", normalized, lambda: sp.search(q=query.strip(), type="track")
+        )
     try:
-        return results["tracks"]["items"][0]["uri"]
+        track = results["tracks"]["items"][0]
     except IndexError:
         return None
+    search_results.set(normalized, track["uri"])
+    get_suggestions().add_track(track["name"], track["artists"][0]["name"])
+    return track["uri"]
+
+
+# The search suggestions of this worker: the tracks found by searches, never the queries
+# themselves, so one visitor's searches aren't suggested to another. Loaded from the index
+# saved at SUGGESTIONS_PATH, so every worker suggests what any of them has found, and
+# loaded again once that copy is more than suggestions_max_age seconds old. One worker at a
+# time (under a file lock) rebuilds the saved index from the searches in the shared
+# response cache when it is older than that.
+def get_suggestions():
+    global suggestions, suggestions_refreshed
+    with suggestions_lock:
+        if time.time() - suggestions_refreshed < suggestions_max_age:
+            return suggestions
+        path = suggestions_path()
+        with open(path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                saved = os.path.getmtime(path)
+                if time.time() - saved < suggestions_max_age:
+                    suggestions = PrefixIndex.load(path, suggestions.max_entries)
+                    suggestions_refreshed = saved
+                    return suggestions
+            except (OSError, ValueError, KeyError):
+                pass
+            rebuilt = PrefixIndex(suggestions.max_entries)
+            searches = api_cache.items("search", limit=rebuilt.max_entries // 2)
+            for normalized, results in searches:
+                items = results["tracks"]["items"]
+                if items:
+                    rebuilt.add_track(items[0]["name"], items[0]["artists"][0]["name"])
+            rebuilt.save(path)
+            suggestions = rebuilt
+            suggestions_refreshed = time.time()
+    return suggestions
+
+
+# The saved suggestions (see get_suggestions) as JSON for the browser to search locally,
+# and a version for its ETag. Every worker serves the same file, so the version is the same
+# whichever worker answers.
+def get_suggestions_index():
+    get_suggestions()
+    with open(suggestions_path(), "rb") as f:
+        saved = os.fstat(f.fileno())
+        data = f.read()
+    return "{:x}-{:x}".format(saved.st_mtime_ns, saved.st_size), data
+
+
+# Get the metadata of a track provided its Spotify URI.
+def get_metadata(track_uri):
+    with stage_seconds.time(stage="track"):
+        return api_cache.cached(
+            "track", track_uri, lambda: sp.track(track_id=track_uri)
+        )
+
+
+# Get the audio features of a track provided its Spotify URI.
+def get_features(track_uri):
+    with stage_seconds.time(stage="audio_features"):
+        return api_cache.cached(
+            "audio_features", track_uri, lambda: sp.audio_features(tracks=track_uri)
+        )
+
+
+# Get the metadata of several tracks, in chunks of the most the API allows per request.
+# Responses are cached per track, so they are shared with the app.
+def get_metadata_many(track_uris):
+    return [
+        metadata
+        for chunk in chunks(track_uris, tracks_limit)
+        for metadata in api_cache.cached_many(
+            "track",
+            chunk,
+            lambda missing: sp.tracks(missing)["tracks"],
+        )
+    ]
+
+
+# Get the audio features of several tracks, cached per track in the same form as
+# get_features (a list with one entry).
+def get_features_many(track_uris):
+    return [
+        audio_features[0]
+        for chunk in chunks(track_uris, audio_features_limit)
+        for audio_features in api_cache.cached_many(
+            "audio_features",
+            chunk,
+            lambda missing: [[features] for features in sp.audio_features(missing)],
+        )
+    ]
 
 
 # Get the metadata and audio features of a track provided its Spotify URI.
-# Returns a pandas dataframe.
-def get_audio_features(track_uri):
-    metadata = sp.track(track_id=track_uri)
-    audio_features = sp.audio_features(tracks=track_uri)
-    return pd.DataFrame(
-        data=[
-            [
-                metadata["name"],
-                metadata["album"]["artists"][0]["name"],
-                metadata["album"]["name"],
-                metadata["album"]["images"][1]["url"],
-                metadata["preview_url"],
-                audio_features[0]["danceability"],
-                audio_features[0]["valence"],
-                audio_features[0]["energy"],
-                audio_features[0]["tempo"],
-                audio_features[0]["loudness"],
-                audio_features[0]["speechiness"],
-                audio_features[0]["instrumentalness"],
-                audio_features[0]["liveness"],
-                audio_features[0]["acousticness"],
-            ]
-        ],
-        columns=[
-            "name",
-            "artist",
-            "album",
-            "image",
-            "preview_url",
-            "danceability",
-            "valence",
-            "energy",
-            "tempo",
-            "loudness",
-            "speechiness",
-            "instrumentalness",
-            "liveness",
-            "acousticness",
-        ],
+# The two requests are made concurrently, each within `timeout` seconds (see fan_out).
+# Returns a TrackRecord.
+def get_audio_features(track_uri, timeout=None):
+    metadata, audio_features = fan_out(
+        [(get_metadata, track_uri), (get_features, track_uri)], timeout=timeout
     )
+    return track_record(track_uri, metadata, audio_features)
 
 
-# Get the audio analysis of a track provided its Spotify URI.
-# Creates a waveform using Plotly Graph Objects, then uses b64encode to return the graph as a static image.
-def get_audio_analysis(track_uri):
-    audio_analysis = sp.audio_analysis(track_id=track_uri)
-    duration = audio_analysis["track"]["duration"]
-    segments = audio_analysis["segments"]
-    segments_map = np.zeros(shape=(len(segments), 3))
-    i = 0
-    for segment in segments:
-        segment_start = segment["start"] / duration
-        segment_duration = segment["duration"] / duration
-        segment_loudness = 1 - (min(max(segment["loudness_max"], -35), 0) / -35)
-        segments_map[i] = [segment_start, segment_duration, segment_loudness]
-        i += 1
-    maximum = np.amax(segments_map, axis=0)[2]
-    levels = []
-    for i in range(0, 1000, 1):
-        for segment in segments_map:
-            if segment[0] <= i / 1000 <= segment[0] + segment[1] and i % 8 == 0:
-                loudness = segment[2] / maximum
-                levels.append([i, loudness / 2, -loudness / 2])
-                break
-    df = pd.DataFrame(levels, columns=["index", "upper_bound", "lower_bound"])
+# Build the TrackRecord of a track and add it to the feature store.
+def track_record(track_uri, metadata, audio_features):
+    record = TrackRecord.from_api(track_uri, metadata, audio_features[0])
+    feature_store.append(record)
+    return record
+
+
+# Build the Plotly figure for a waveform from its binned levels.
+# Plotly is imported on first use, since only the png and graph render modes need it.
+def waveform_figure(index, levels, structure=None):
+    import plotly.graph_objects as go
+
     trace1 = go.Bar(
-        x=df["index"],
-        y=df["upper_bound"],
+        x=index,
+        y=levels / 2,
         marker_color=colors["pink"],
         marker_line_width=0,
     )
     trace2 = go.Bar(
-        x=df["index"],
-        y=df["lower_bound"],
+        x=index,
+        y=-levels / 2,
         marker_color=colors["pink"],
         marker_line_width=0,
     )
     data = [trace1, trace2]
+    shapes = []
+    if structure is not None:
+        spacing = np.min(np.diff(index)) if len(index) > 1 else 1000
+        data += structure_traces(structure, -spacing / 2)
+        shapes = structure_shapes(structure, -spacing / 2)
     layout = go.Layout(
+        shapes=shapes,
         barmode="overlay",
         showlegend=False,
         xaxis=dict(
@@ -132,11 +309,382 @@ def get_audio_analysis(track_uri):
             t=0,
         ),
     )
-    fig = go.Figure(data=data, layout=layout)
-    img_bytes = fig.to_image(format="png")
-    encoding = b64encode(img_bytes).decode()
-    img_b64 = "data:image/png;base64," + encoding
-    return img_b64
+    return go.Figure(data=data, layout=layout)
+
+
+# Vertical lines at positions (fractions of the track) on a waveform figure 1000 wide
+# starting at x = left, as one Plotly line trace broken up by None gaps.
+def marker_trace(positions, left, bottom, top, opacity):
+    import plotly.graph_objects as go
+
+    x = np.repeat(left + positions * 1000, 3).astype(object)
+    x[2::3] = None
+    y = np.tile(np.array([bottom, top, None], dtype=object), len(positions))
+    return go.Scatter(
+        x=x,
+        y=y,
+        mode="lines",
+        line=dict(color="#ffffff", width=1),
+        opacity=opacity,
+        hoverinfo="skip",
+    )
+
+
+# The bars and beats of a track's structure (see waveform.track_structure) drawn over its
+# waveform figure: a line at the start of every bar and a tick at the bottom for every beat.
+def structure_traces(structure, left):
+    return [
+        marker_trace(structure["bars"], left, -0.5, 0.5, 0.25),
+        marker_trace(structure["beats"], left, -0.5, -0.47, 0.5),
+    ]
+
+
+# The sections of a track's structure shaded behind its waveform figure, each as brightly
+# as it is energetic.
+def structure_shapes(structure, left):
+    return [
+        dict(
+            type="rect",
+            layer="below",
+            xref="x",
+            yref="paper",
+            x0=left + start * 1000,
+            x1=left + end * 1000,
+            y0=0,
+            y1=1,
+            fillcolor="#ffffff",
+            opacity=0.04 + 0.16 * energy,
+            line_width=0,
+        )
+        for start, end, energy in structure["sections"].tolist()
+    ]
+
+
+# Render binned waveform levels in the given render mode.
+# "png" exports the Plotly figure through Kaleido and returns it as a base64 data URI,
+# "svg" builds an SVG data URI directly from the levels and "graph" returns the figure
+# as a plain figure dict for a dcc.Graph to draw in the browser.
+# The track's structure (see waveform.track_structure) is drawn over the waveform if given.
+def render_waveform(index, levels, render, structure=None):
+    if render == "png":
+        with stage_seconds.time(stage="render"):
+            figure = waveform_figure(index, levels, structure)
+            img_bytes = figure.to_image(format="png")
+        with stage_seconds.time(stage="encode"):
+            encoding = b64encode(img_bytes).decode()
+        return "data:image/png;base64," + encoding
+    elif render == "svg":
+        with stage_seconds.time(stage="render"):
+            svg = levels_svg(
+                index, levels, colors["pink"], colors["black"], structure=structure
+            )
+        with stage_seconds.time(stage="encode"):
+            encoding = b64encode(svg.encode()).decode()
+        return "data:image/svg+xml;base64," + encoding
+    elif render == "graph":
+        with stage_seconds.time(stage="render"):
+            figure = waveform_figure(index, levels, structure).to_json()
+        with stage_seconds.time(stage="encode"):
+            return json.loads(figure)
+    else:
+        raise ValueError("Unknown waveform render mode: {}".format(render))
+
+
+# Get the segments of a track's audio analysis provided its Spotify URI, as a
+# segments.SegmentFile (which also holds its bars, beats, tatums and sections). The
+# analysis JSON is only fetched the first time a track is seen. It is the largest
+# response and the segment store already keeps it, so it only goes through the response
+# cache in offline mode, where the cache replays recorded analyses.
+def get_segments(track_uri):
+    def fetch():
+        if api_cache.offline:
+            return api_cache.get("audio_analysis", track_uri)
+        return sp.audio_analysis(track_id=track_uri)
+
+    return segment_store.cached(track_uri, fetch)
+
+
+# Key of a track's rendered waveform in the waveform cache.
+def waveform_key(track_uri, bins=125, aggregation="sample", render=None):
+    render = render or waveform_render
+    return artifact_key(track_uri, bins=bins, aggregation=aggregation, render=render)
+
+
+# Get the audio analysis of a track provided its Spotify URI.
+# Bins the track's segments into a waveform and renders it with render_waveform.
+# The bar count and the way segments are reduced into each bar can be changed with bins and aggregation.
+# Rendered waveforms are cached by track and settings, so repeat lookups skip both the analysis and the render.
+def get_audio_analysis(track_uri, bins=125, aggregation="sample", render=None):
+    render = render or waveform_render
+    key = waveform_key(track_uri, bins=bins, aggregation=aggregation, render=render)
+    return waveform_cache.cached(
+        key, lambda: analyse_and_render(track_uri, bins, aggregation, render)
+    )
+
+
+# File extensions of the waveform images served by the app, by MIME type.
+asset_extensions = {"image/png": "png", "image/svg+xml": "svg"}
+
+
+# Get a track's waveform image as the name of an asset for the app to serve (see app.py)
+# instead of inlining it in the callback response: "<track ID>/<content hash>.<extension>".
+# The image is kept in the response cache under its hash, so any worker can serve it and
+# its URL never has to change; if it is evicted, the track ID lets it be drawn again.
+# Only the image render modes ("png" and "svg") can be served.
+def get_waveform_asset_name(track_uri):
+    if waveform_render not in ("png", "svg"):
+        raise ValueError(
+            "Only png and svg waveforms are served as assets, not {}".format(
+                waveform_render
+            )
+        )
+    rendered = get_audio_analysis(track_uri)
+    digest = hashlib.sha256(rendered.encode()).hexdigest()
+    if not api_cache.contains("waveform_asset", digest):
+        api_cache.set("waveform_asset", digest, rendered)
+    mimetype = rendered[len("data:") : rendered.index(";")]
+    track_id = track_uri.rsplit(":", 1)[-1]
+    return "{}/{}.{}".format(track_id, digest, asset_extensions[mimetype])
+
+
+# The MIME type and bytes of a waveform image given its content hash, or None if it isn't
+# cached.
+def get_waveform_asset(digest):
+    try:
+        rendered = api_cache.get("waveform_asset", digest)
+    except CacheMiss:
+        return None
+    header, data = rendered.split(",", 1)
+    return header[len("data:") : -len(";base64")], b64decode(data)
+
+
+# "pyramid" waveforms aren't binned at a single resolution, they are sent to the browser as
+# an encoded waveform pyramid for it to draw and zoom into (see assets/waveform.js).
+# Every waveform is drawn with the track's sections, bars and beats over it.
+def analyse_and_render(track_uri, bins, aggregation, render):
+    with stage_seconds.time(stage="audio_analysis"):
+        segments = get_segments(track_uri)
+    duration = segments.duration
+    if render == "pyramid":
+        with stage_seconds.time(stage="binning"):
+            pyramid = build_pyramid(segments, duration)
+            structure = track_structure(segments, duration)
+        with stage_seconds.time(stage="encode"):
+            rendered = encode_pyramid(pyramid, duration, structure)
+    else:
+        with stage_seconds.time(stage="binning"):
+            index, levels = bin_levels(
+                segments, duration, bins=bins, aggregation=aggregation
+            )
+            structure = track_structure(segments, duration)
+        rendered = render_waveform(index, levels, render, structure)
+    size = len(rendered) if isinstance(rendered, str) else len(json.dumps(rendered))
+    payload_bytes.observe(size, render=render)
+    return rendered
+
+
+# Get a track's waveform with render (get_audio_analysis, or get_waveform_asset_name for
+# an image URL) on the thread pool, waiting at most `timeout` seconds. The track can
+# still be shown without a waveform, so one that takes longer is returned as None; it
+# keeps rendering in the background and is cached for the next lookup.
+def get_waveform(track_uri, render=None, timeout=None):
+    timeout = fetch_timeout if timeout is None else timeout
+    waveform = executor().submit(render or get_audio_analysis, track_uri)
+    try:
+        return waveform.result(timeout)
+    except futures.TimeoutError:
+        return None
+
+
+# Get the tracks with audio features closest to a track's, among the tracks in the feature
+# store (including those looked up by other workers). Returns a list of TrackRecords.
+def get_similar_tracks(record, k=5):
+    index = get_similar_index()
+    index.sync(feature_store)
+    features = [np.nan if value is None else value for value in record.features()]
+    matches = index.query(features, k=k, exclude={record.uri})
+    uris = [uri for uri, distance in matches]
+    metadata, audio_features = fan_out(
+        [(get_metadata_many, uris), (get_features_many, uris)]
+    )
+    return [
+        TrackRecord.from_api(*responses)
+        for responses in zip(uris, metadata, audio_features)
+    ]
+
+
+# Look up several tracks to compare them, given one search query per track (at most
+# compare_limit). The searches and audio analyses run concurrently, and the metadata and
+# audio features of all the tracks are fetched with one batched request each, so server
+# time grows much slower than the number of tracks.
+# Returns the TrackRecords of the tracks found, the queries nothing was found for, the
+# waveform levels of the tracks found as a (tracks, bins) array (each track's levels
+# normalized to its own loudest segment) and their durations in seconds. Like a single
+# lookup, a track whose audio analysis is missing or too slow is still compared, with a
+# row of NaN levels and a NaN duration instead of a waveform.
+def compare_tracks(queries, bins=256):
+    queries = [query for query in queries if normalize_query(query)]
+    queries = queries[:compare_limit]
+    uris = fan_out([(get_track_uri, query) for query in queries], timeout=fetch_timeout)
+    not_found = [query for query, uri in zip(queries, uris) if uri is None]
+    uris = list(dict.fromkeys(uri for uri in uris if uri is not None))
+    started = time.monotonic()
+    segments = [executor().submit(get_segments, uri) for uri in uris]
+    metadata, audio_features = fan_out(
+        [(get_metadata_many, uris), (get_features_many, uris)], timeout=fetch_timeout
+    )
+    records = [
+        TrackRecord.from_api(*responses)
+        for responses in zip(uris, metadata, audio_features)
+    ]
+    for record in records:
+        feature_store.append(record)
+    levels = np.full((len(uris), bins), np.nan, dtype=np.float16)
+    durations = np.full(len(uris), np.nan)
+    for row, future in enumerate(segments):
+        try:
+            track_segments = future.result(
+                max(0, started + fetch_timeout - time.monotonic())
+            )
+        except (SpotifyException, futures.TimeoutError):
+            continue
+        pyramid = build_pyramid(track_segments, track_segments.duration, (bins,))
+        levels[row] = pyramid[bins]
+        durations[row] = track_segments.duration
+    return records, not_found, levels, durations
+
+
+# Plotly figures comparing tracks found by compare_tracks: one radar chart of every
+# track's audio features (scaled onto [0, 1] like the similar-track index does) and one
+# chart of all their waveforms overlaid, on a shared time axis.
+def comparison_figures(records, levels, durations):
+    import plotly.graph_objects as go
+
+    features = normalize(
+        [
+            [np.nan if value is None else value for value in r.features()]
+            for r in records
+        ]
+    )
+    names = [name.upper() for name in feature_names]
+    positions = np.arange(levels.shape[1]) / levels.shape[1]
+    times = positions[None, :] * durations[:, None]
+    radar = []
+    waveforms = []
+    for record, row, x, y, color in zip(
+        records, features, times, levels, compare_colors
+    ):
+        label = "{} by {}".format(record.name, record.artist)
+        radar.append(
+            go.Scatterpolar(
+                r=np.append(row, row[0]),
+                theta=names + names[:1],
+                name=label,
+                line_color=color,
+                fill="toself",
+                opacity=0.6,
+            )
+        )
+        waveforms.append(
+            go.Scatter(
+                x=x,
+                y=y.astype(float),
+                name=label,
+                mode="lines",
+                line_shape="hv",
+                line_color=color,
+                line_width=1,
+                opacity=0.8,
+            )
+        )
+    layout = dict(
+        paper_bgcolor=colors["black"],
+        plot_bgcolor=colors["black"],
+        font_color=colors["white"],
+        legend=dict(orientation="h"),
+        margin=dict(l=40, r=40, b=40, t=40),
+    )
+    radar_figure = go.Figure(data=radar, layout=layout)
+    radar_figure.update_polars(
+        bgcolor=colors["black"],
+        radialaxis=dict(range=[0, 1], showticklabels=False),
+    )
+    waveform_figure = go.Figure(data=waveforms, layout=layout)
+    waveform_figure.update_xaxes(title="Seconds", showgrid=False)
+    waveform_figure.update_yaxes(showticklabels=False, showgrid=False, zeroline=False)
+    return radar_figure, waveform_figure
+
+
+# The similar-track index, loaded from disk the first time it's needed.
+def get_similar_index():
+    global similar_index
+    with similar_index_lock:
+        if similar_index is None:
+            similar_index = similar_index_from_environment()
+    return similar_index
+
+
+# The feature distributions, loaded from disk the first time they're needed.
+def get_distributions():
+    global distributions
+    with distributions_lock:
+        if distributions is None:
+            distributions = distributions_from_environment()
+    return distributions
+
+
+# Percentile ranks of a track's audio features among every track in the feature store
+# and among its artist's tracks, as a dict of feature name to a pair of percentiles
+# (either is None when there is too little to rank against).
+def get_percentile_ranks(record):
+    corpus = get_distributions()
+    corpus.sync(feature_store)
+    return {
+        name: (
+            corpus.rank(name, value),
+            corpus.artist_rank(record.artist, name, value),
+        )
+        for name, value in zip(feature_names, record.features())
+    }
+
+
+# Run calls of the form (function, *args) on the thread pool and return their results in
+# order. Each call must finish within `timeout` seconds of being submitted.
+def fan_out(calls, timeout=None):
+    timeout = fetch_timeout if timeout is None else timeout
+    started = time.monotonic()
+    submitted = [executor().submit(*call) for call in calls]
+    return [
+        future.result(max(0, started + timeout - time.monotonic()))
+        for future in submitted
+    ]
+
+
+# The thread pool used for concurrent Spotify API calls. Threads don't survive a fork,
+# so each process creates its own pool the first time it is needed.
+def executor():
+    global pool, pool_pid
+    if pool is None or pool_pid != os.getpid():
+        pool = futures.ThreadPoolExecutor(max_workers=fetch_threads)
+        pool_pid = os.getpid()
+    return pool
+
+
+# Get a worker ready to serve requests before its first one arrives: start its thread pool,
+# load the similar-track index, feature distributions (caught up with the feature store)
+# and search suggestions and, in png mode, start Kaleido's headless browser by rendering
+# a blank waveform. Meant to run in each worker after it is forked (see gunicorn.conf.py),
+# since none of these survive a fork.
+def prewarm():
+    executor()
+    get_similar_index()
+    get_distributions().sync(feature_store)
+    get_suggestions()
+    if waveform_render == "png":
+        try:
+            render_waveform(np.zeros(1), np.zeros(1), "png")
+        except Exception:
+            logging.getLogger(__name__).warning("Kaleido prewarm failed", exc_info=True)
 
 
 # Returns descriptions of the different audio features provided in the Spotify API.
@@ -0,0 +1,32 @@
+from functions import prewarm
+from warmer import spawn_warmer
+
+
+# Import the app once in the master process so workers start from a forked copy of it
+# instead of each importing Dash, NumPy and spotipy and building the layout themselves.
+preload_app = True
+
+# Serve the staged callbacks of a search in parallel.
+threads = 4
+
+
+# Thread pools, SQLite connections and Kaleido don't survive a fork, so each worker starts
+# its own before it takes requests.
+def post_fork(server, worker):
+    prewarm()
+
+
+# The cache warmer runs beside the workers, so it fills the caches they read (see
+# warmer.spawn_warmer).
+warmer = None
+
+
+def when_ready(server):
+    global warmer
+    warmer = spawn_warmer()
+
+
+def on_exit(server):
+    if warmer is not None:
+        warmer.terminate()
+        warmer.wait()
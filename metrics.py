@@ -0,0 +1,240 @@
+import cProfile
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+
+# A rolling window of the most recent durations (in seconds) of something, with a
+# summary of their percentiles.
+class Timings:
+    def __init__(self, size=1000):
+        self.values = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.values.append(seconds)
+
+    def summary(self):
+        with self.lock:
+            values = np.array(self.values)
+        if len(values) == 0:
+            return {"count": 0}
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        return {"count": len(values), "p50": p50, "p95": p95, "p99": p99}
+
+
+# Upper bounds of the latency histogram buckets in seconds, and of the payload size
+# histogram buckets in bytes (1 KiB to 4 MiB).
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+size_buckets = tuple(1024 * 4**i for i in range(7))
+
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, escape(v)) for k, v in pairs) + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# A Prometheus histogram: counts of observations below each bucket bound, plus their sum
+# and count, kept separately for every combination of label values. Every gunicorn worker
+# keeps its own, so they are exposed with a pid label to tell the workers' series apart.
+class Histogram:
+    def __init__(self, name, help, buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self.bounds = np.array(buckets + (float("inf"),))
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        bucket = np.searchsorted(self.bounds, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [np.zeros(len(self.bounds), int), 0.0]
+            series[0][bucket] += 1
+            series[1] += value
+
+    # Time the body of a with statement and observe its duration in seconds.
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def expose(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        with self.lock:
+            series = [
+                (key, counts.cumsum(), total)
+                for key, (counts, total) in self.series.items()
+            ]
+        pid = os.getpid()
+        for key, cumulative, total in sorted(series):
+            for bound, count in zip(self.bounds, cumulative):
+                labels = format_labels(key, pid=pid, le=format_value(float(bound)))
+                lines.append("{}_bucket{} {}".format(self.name, labels, count))
+            labels = format_labels(key, pid=pid)
+            lines.append("{}_sum{} {}".format(self.name, labels, format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, labels, cumulative[-1]))
+        return lines
+
+
+# A Prometheus counter whose values are read when the metrics are exposed, from a function
+# returning a list of (labels dict, value) pairs. Used for counts kept elsewhere, such as
+# cache hits. Counts kept by each process get a pid label like histograms; counts shared
+# by every worker (per_process=False) don't, so they aren't added up more than once.
+class CollectedCounter:
+    def __init__(self, name, help, collect, per_process=True):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.per_process = per_process
+
+    def expose(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} counter".format(self.name),
+        ]
+        extra = {"pid": os.getpid()} if self.per_process else {}
+        for labels, value in self.collect():
+            lines.append(
+                "{}{} {}".format(
+                    self.name,
+                    format_labels(sorted(labels.items()), **extra),
+                    format_value(value),
+                )
+            )
+        return lines
+
+
+# The metrics of this process, exposed together in the Prometheus text format.
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+# Time spent in each stage of looking up and drawing a track.
+stage_seconds = registry.register(
+    Histogram("pipeline_stage_seconds", "Time spent in each stage of a track lookup.")
+)
+# Size of each rendered waveform sent to the browser.
+payload_bytes = registry.register(
+    Histogram(
+        "waveform_payload_bytes",
+        "Size of rendered waveforms sent to the browser.",
+        buckets=size_buckets,
+    )
+)
+# Time taken to serve each request, by Dash callback (or path for other requests).
+request_seconds = registry.register(
+    Histogram("request_seconds", "Time taken to serve requests.")
+)
+
+
+# Profiles slow requests with cProfile and saves each profile to a .prof file (open them
+# with pstats or snakeviz). Switched on at runtime, for every worker on the host, by
+# writing a threshold in milliseconds to the control file: requests slower than it are
+# saved. Deleting the file switches profiling off. The file is checked at most once a
+# second. Only one request per worker is profiled at a time, and only the thread serving
+# it, so time spent waiting on the fetch thread pool shows up as waiting.
+class SlowRequestProfiler:
+    def __init__(self, control_path, directory):
+        self.control_path = control_path
+        self.directory = directory
+        self.threshold = None
+        self.checked = 0
+        self.busy = threading.Lock()
+        self.local = threading.local()
+
+    # Slow request threshold in seconds, or None while profiling is switched off.
+    def enabled(self):
+        now = time.monotonic()
+        if now - self.checked >= 1:
+            self.checked = now
+            try:
+                with open(self.control_path) as f:
+                    self.threshold = float(f.read().strip() or 0) / 1000
+            except (OSError, ValueError):
+                self.threshold = None
+        return self.threshold
+
+    def start(self):
+        if self.enabled() is None or not self.busy.acquire(blocking=False):
+            return
+        self.local.profile = cProfile.Profile()
+        self.local.started = time.perf_counter()
+        self.local.profile.enable()
+
+    # Stop profiling the current request, saving the profile if the request was slow.
+    # Returns the path of the saved profile, if any.
+    def stop(self, name):
+        profile = getattr(self.local, "profile", None)
+        if profile is None:
+            return None
+        profile.disable()
+        self.local.profile = None
+        self.busy.release()
+        elapsed = time.perf_counter() - self.local.started
+        if elapsed < (self.threshold or 0):
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(
+            self.directory,
+            "{}-{}-{}ms.prof".format(
+                time.strftime("%Y%m%d-%H%M%S"),
+                "".join(c if c.isalnum() else "_" for c in name)[:60],
+                int(elapsed * 1000),
+            ),
+        )
+        profile.dump_stats(path)
+        return path
+
+
+# Build the slow request profiler from environment variables. PROFILE_CONTROL_PATH sets
+# the control file that switches it on and PROFILE_DIR where profiles are saved (both
+# default to the system temp directory).
+def profiler_from_environment():
+    return SlowRequestProfiler(
+        os.environ.get(
+            "PROFILE_CONTROL_PATH",
+            os.path.join(tempfile.gettempdir(), "spotify-data-visualizer.profile"),
+        ),
+        os.environ.get(
+            "PROFILE_DIR",
+            os.path.join(tempfile.gettempdir(), "spotify-data-visualizer-profiles"),
+        ),
+    )
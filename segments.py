@@ -0,0 +1,273 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+import numpy as np
+
+
+# The fields kept from each segment of an audio analysis and how they are stored: times
+# and loudness as float32, the rest (confidence and the 12 pitch and timbre coefficients)
+# as float16, which is plenty for values shown on a screen.
+segment_columns = {
+    "start": ("<f4", ()),
+    "duration": ("<f4", ()),
+    "loudness_start": ("<f4", ()),
+    "loudness_max_time": ("<f4", ()),
+    "loudness_max": ("<f4", ()),
+    "confidence": ("<f2", ()),
+    "pitches": ("<f2", (12,)),
+    "timbre": ("<f2", (12,)),
+}
+
+# The other time intervals of an audio analysis, stored the same way as the segments.
+# Sections also carry their loudness, tempo and musical key, mode and time signature.
+interval_columns = {
+    "start": ("<f4", ()),
+    "duration": ("<f4", ()),
+    "confidence": ("<f2", ()),
+}
+tables = {
+    "segments": segment_columns,
+    "bars": interval_columns,
+    "beats": interval_columns,
+    "tatums": interval_columns,
+    "sections": dict(
+        interval_columns,
+        loudness=("<f4", ()),
+        tempo=("<f4", ()),
+        key=("<f2", ()),
+        mode=("<f2", ()),
+        time_signature=("<f2", ()),
+    ),
+}
+
+# Ways the columns of a segment file can be compressed. zstd needs the zstandard package.
+compressions = (None, "zlib", "zstd")
+
+magic = b"SEGCOLS2"
+# Columns start on multiples of this many bytes, so they can be memory mapped as arrays.
+alignment = 64
+
+
+def compressor(compression):
+    if compression == "zlib":
+        return zlib.compress
+    if compression == "zstd":
+        import zstandard  # optional, only needed for zstd compressed segment files
+
+        return zstandard.ZstdCompressor().compress
+    return bytes
+
+
+def decompressor(compression):
+    if compression == "zlib":
+        return zlib.decompress
+    if compression == "zstd":
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompress
+    return bytes
+
+
+# Encode an audio analysis as a segment file: the magic bytes, the length of a JSON header,
+# the header (the track duration and, for every table, its row count and the dtype, shape,
+# size and offset from the end of the header of each of its columns) and then each column
+# as a raw little-endian array. Columns start on aligned offsets. Missing values are
+# stored as NaN.
+def encode_segments(audio_analysis, compression=None):
+    if compression not in compressions:
+        raise ValueError("Unknown compression: {}".format(compression))
+    compress = compressor(compression)
+    header = {
+        "duration": audio_analysis["track"]["duration"],
+        "compression": compression,
+        "tables": {},
+    }
+    blobs = []
+    offset = 0
+    for table, columns in tables.items():
+        rows = audio_analysis.get(table) or []
+        specs = {}
+        for name, (dtype, shape) in columns.items():
+            empty = [np.nan] * shape[0] if shape else np.nan
+            values = [row.get(name, empty) for row in rows]
+            column = np.array(values, dtype=dtype).reshape((len(rows),) + shape)
+            blob = compress(column.tobytes())
+            specs[name] = {
+                "dtype": dtype,
+                "shape": list(shape),
+                "offset": offset,
+                "size": len(blob),
+            }
+            blobs.append((offset, blob))
+            offset = aligned(offset + len(blob))
+        header["tables"][table] = {"count": len(rows), "columns": specs}
+    encoded = json.dumps(header).encode()
+    start = aligned(len(magic) + 4 + len(encoded))
+    parts = [magic, struct.pack("<I", len(encoded)), encoded]
+    position = len(magic) + 4 + len(encoded)
+    for offset, blob in blobs:
+        parts.append(b"\0" * (start + offset - position))
+        parts.append(blob)
+        position = start + offset + len(blob)
+    return b"".join(parts)
+
+
+def aligned(offset):
+    return -(-offset // alignment) * alignment
+
+
+# Write a segment file, replacing any old file atomically.
+def write_segments(path, audio_analysis, compression=None):
+    data = encode_segments(audio_analysis, compression)
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".seg", delete=False) as f:
+        f.write(data)
+    os.replace(f.name, path)
+
+
+# A segment file opened for reading. Its segments' columns are read on demand with
+# file["loudness_max"], the columns of the other intervals with file.table("beats")["start"].
+# The whole file is memory mapped when it is opened, so only the pages of the columns used
+# are ever read, and it stays readable even if the store evicts it meanwhile. Compressed
+# columns are decompressed once and kept.
+class SegmentFile:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[: len(magic)] != magic:
+            raise ValueError("Not a current segment file: {}".format(path))
+        (length,) = struct.unpack_from("<I", self.buffer, len(magic))
+        header = json.loads(self.buffer[len(magic) + 4 : len(magic) + 4 + length])
+        self.duration = header["duration"]
+        self.compression = header["compression"]
+        self.tables = {
+            name: Table(self, table["count"], table["columns"])
+            for name, table in header["tables"].items()
+        }
+        self.start = aligned(len(magic) + 4 + length)
+
+    def __len__(self):
+        return len(self.tables["segments"])
+
+    def __getitem__(self, name):
+        return self.tables["segments"][name]
+
+    def table(self, name):
+        return self.tables[name]
+
+    def read(self, spec, count):
+        shape = (count,) + tuple(spec["shape"])
+        if count == 0:
+            return np.zeros(shape, dtype=spec["dtype"])
+        offset = self.start + spec["offset"]
+        if self.compression is None:
+            return np.ndarray(
+                shape, dtype=spec["dtype"], buffer=self.buffer, offset=offset
+            )
+        data = decompressor(self.compression)(
+            self.buffer[offset : offset + spec["size"]]
+        )
+        return np.frombuffer(data, dtype=spec["dtype"]).reshape(shape)
+
+
+# The columns of one table of a segment file, each read the first time it's used.
+class Table:
+    def __init__(self, file, count, columns):
+        self.file = file
+        self.count = count
+        self.columns = columns
+        self.loaded = {}
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, name):
+        column = self.loaded.get(name)
+        if column is None:
+            column = self.loaded[name] = self.file.read(self.columns[name], self.count)
+        return column
+
+
+# A directory of segment files, one per track, that stands in for the audio analysis JSON.
+# Like the response cache, the least recently used files are evicted once the total size
+# passes max_bytes; a file's modification time is bumped whenever it is used.
+class SegmentStore:
+    def __init__(self, directory, compression=None, max_bytes=512 * 1024 * 1024):
+        if compression not in compressions:
+            raise ValueError("Unknown compression: {}".format(compression))
+        self.directory = directory
+        self.compression = compression
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, track_uri):
+        track_id = track_uri.rsplit(":", 1)[-1]
+        return os.path.join(self.directory, track_id + ".seg")
+
+    def contains(self, track_uri):
+        return os.path.exists(self.path(track_uri))
+
+    # Return the segment file of a track, writing it from the audio analysis that fetch
+    # returns if the track has none yet (or only one in an older format).
+    def cached(self, track_uri, fetch):
+        path = self.path(track_uri)
+        try:
+            segment_file = SegmentFile(path)
+            os.utime(path)
+            return segment_file
+        except (OSError, ValueError):
+            write_segments(path, fetch(), self.compression)
+        segment_file = SegmentFile(path)
+        self.evict()
+        return segment_file
+
+    # Remove the least recently used files until the store is back under 90% of max_bytes.
+    # Files already opened stay readable, since SegmentFile maps them whole.
+    def evict(self):
+        files = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".seg"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:  # evicted by another worker meanwhile
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        for mtime, size, path in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".seg"):
+                os.remove(os.path.join(self.directory, name))
+
+
+# Build the segment store from environment variables. SEGMENT_STORE_PATH sets its
+# directory (defaults to one in the system temp directory) and SEGMENT_STORE_COMPRESSION
+# how new files are compressed ("zlib" or "zstd", uncompressed by default so they can be
+# memory mapped). SEGMENT_STORE_MAX_MB caps its total size (default 512).
+def segment_store_from_environment():
+    return SegmentStore(
+        os.environ.get(
+            "SEGMENT_STORE_PATH",
+            os.path.join(tempfile.gettempdir(), "spotify-data-visualizer-segments"),
+        ),
+        compression=os.environ.get("SEGMENT_STORE_COMPRESSION") or None,
+        max_bytes=int(
+            float(os.environ.get("SEGMENT_STORE_MAX_MB", "512")) * 1024 * 1024
+        ),
+    )
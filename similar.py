@@ -0,0 +1,247 @@
+import os
+import tempfile
+import threading
+import numpy as np
+from feature_store import feature_names
+
+
+# Range each audio feature is scaled from onto [0, 1] before comparing tracks, so tempo
+# (in BPM) and loudness (in dB) don't outweigh the features that are already in [0, 1].
+# Fixed ranges keep the scaling the same as tracks are added.
+feature_ranges = {
+    "tempo": (0, 250),
+    "loudness": (-60, 0),
+}
+scale_low, scale_high = np.array(
+    [feature_ranges.get(name, (0, 1)) for name in feature_names], dtype="f4"
+).T
+scale_span = scale_high - scale_low
+
+# Above this many tracks, searching every track gets too slow and the index switches to
+# an inverted file (IVF): tracks are grouped around cluster centroids and a query only
+# searches the tracks of the clusters closest to it.
+ivf_threshold = 100000
+
+
+# Scale rows of raw audio features (in the order of feature_names) onto [0, 1].
+def normalize(features):
+    return np.clip((np.asarray(features, dtype="f4") - scale_low) / scale_span, 0, 1)
+
+
+# Cluster vectors with k-means, returning the centroids. Trained on a sample of at most
+# 64 vectors per cluster, which is plenty for grouping tracks into search cells.
+def kmeans(vectors, clusters, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), clusters * 64)
+    sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assigned = nearest_centroid(sample, centroids)
+        counts = np.bincount(assigned, minlength=clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assigned, sample)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+# Index of the nearest centroid for every vector, computed in chunks to bound memory.
+def nearest_centroid(vectors, centroids, chunk=16384):
+    squared = (centroids * centroids).sum(axis=1)
+    return np.concatenate(
+        [
+            np.argmin(squared - 2 * vectors[i : i + chunk] @ centroids.T, axis=1)
+            for i in range(0, len(vectors), chunk)
+        ]
+        or [np.zeros(0, dtype=int)]
+    )
+
+
+# A nearest-neighbour index of tracks by their normalized audio features.
+# Small corpora are searched exhaustively with one matrix-vector product. Once the index
+# holds more than ivf_threshold tracks it builds an IVF with about sqrt(n) clusters and
+# searches the nprobe clusters nearest to each query instead.
+# Tracks can be added at any time; adding a track that's already indexed replaces it.
+class SimilarityIndex:
+    def __init__(self, nprobe=8):
+        self.nprobe = nprobe
+        self.vectors = np.zeros((0, len(feature_names)), dtype="f4")
+        self.norms = np.zeros(0, dtype="f4")
+        self.uris = []
+        self.rows = {}
+        self.count = 0
+        self.synced = 0
+        self.centroids = None
+        self.cells = np.zeros(0, dtype="i4")
+        self.cell_order = None
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return self.count
+
+    # Make room for at least `extra` more tracks, doubling the arrays as they fill up.
+    def reserve(self, extra):
+        needed = self.count + extra
+        if needed <= len(self.vectors):
+            return
+        capacity = max(needed, 2 * len(self.vectors), 1024)
+        self.vectors = np.resize(self.vectors, (capacity, len(feature_names)))
+        self.norms = np.resize(self.norms, capacity)
+        self.cells = np.resize(self.cells, capacity)
+
+    # Add tracks given their URIs and a matrix of their raw audio features.
+    # Tracks with missing features (NaN) are skipped.
+    def add(self, uris, features):
+        vectors = normalize(np.atleast_2d(features))
+        complete = ~np.isnan(vectors).any(axis=1)
+        vectors = vectors[complete]
+        with self.lock:
+            self.reserve(len(vectors))
+            rows = np.empty(len(vectors), dtype=int)
+            for i, uri in enumerate(np.asarray(uris)[complete].tolist()):
+                row = self.rows.get(uri)
+                if row is None:
+                    row = self.rows[uri] = self.count
+                    self.uris.append(uri)
+                    self.count += 1
+                rows[i] = row
+            self.vectors[rows] = vectors
+            self.norms[rows] = (vectors * vectors).sum(axis=1)
+            if self.centroids is not None:
+                self.cells[rows] = nearest_centroid(vectors, self.centroids)
+            self.cell_order = None
+            if self.centroids is None and self.count > ivf_threshold:
+                self.build_ivf()
+
+    # Catch up with rows appended to a FeatureStore since the last sync, so every worker
+    # sees the tracks the others have looked up.
+    def sync(self, store):
+        total = len(store)
+        if total <= self.synced:
+            return
+        rows = store.read()[self.synced : total]
+        uris = np.char.decode(rows["uri"])
+        features = np.stack([rows[name] for name in feature_names], axis=1)
+        self.add(uris, features)
+        self.synced = total
+
+    # Cluster the indexed tracks into about sqrt(n) cells for IVF search.
+    def build_ivf(self, clusters=None):
+        with self.lock:
+            vectors = self.vectors[: self.count]
+            clusters = clusters or max(1, int(np.sqrt(self.count)))
+            self.centroids = kmeans(vectors, clusters)
+            self.cells[: self.count] = nearest_centroid(vectors, self.centroids)
+            self.cell_order = None
+
+    # Rows sorted by cell, with the offset of each cell's first row, so the rows of a
+    # cell are a contiguous slice. Rebuilt lazily after tracks are added.
+    def ordered_cells(self):
+        if self.cell_order is None:
+            order = np.argsort(self.cells[: self.count], kind="stable")
+            offsets = np.searchsorted(
+                self.cells[: self.count][order], np.arange(len(self.centroids) + 1)
+            )
+            self.cell_order = order, offsets
+        return self.cell_order
+
+    def candidates(self, vector):
+        if self.centroids is None:
+            return None
+        order, offsets = self.ordered_cells()
+        distances = ((self.centroids - vector) ** 2).sum(axis=1)
+        probe = np.argsort(distances)[: self.nprobe]
+        return np.concatenate([order[offsets[c] : offsets[c + 1]] for c in probe])
+
+    # The k tracks nearest to raw audio features, as a list of (uri, distance) pairs from
+    # nearest to furthest. URIs in `exclude` (such as the query track itself) are left out.
+    def query(self, features, k=5, exclude=()):
+        vector = normalize(features)
+        if np.isnan(vector).any():
+            return []
+        with self.lock:
+            rows = self.candidates(vector)
+            if rows is None:
+                vectors, norms = self.vectors[: self.count], self.norms[: self.count]
+            else:
+                vectors, norms = self.vectors[rows], self.norms[rows]
+            distances = norms - 2 * (vectors @ vector) + vector @ vector
+            wanted = min(k + len(exclude), len(distances))
+            if wanted == 0:
+                return []
+            nearest = np.argpartition(distances, wanted - 1)[:wanted]
+            nearest = nearest[np.argsort(distances[nearest])]
+            found = rows[nearest] if rows is not None else nearest
+            results = [
+                (self.uris[row], float(np.sqrt(max(distance, 0))))
+                for row, distance in zip(found, distances[nearest])
+                if self.uris[row] not in exclude
+            ]
+        return results[:k]
+
+    # Save the index to a .npz file, replacing the old file atomically.
+    def save(self, path):
+        with self.lock:
+            centroids = self.centroids
+            if centroids is None:
+                centroids = np.zeros((0, len(feature_names)), dtype="f4")
+            directory = os.path.dirname(os.path.abspath(path))
+            with tempfile.NamedTemporaryFile(
+                dir=directory, suffix=".npz", delete=False
+            ) as f:
+                np.savez(
+                    f,
+                    vectors=self.vectors[: self.count],
+                    uris=np.array(self.uris, dtype=str),
+                    synced=self.synced,
+                    centroids=centroids,
+                )
+            os.replace(f.name, path)
+
+    @classmethod
+    def load(cls, path, nprobe=8):
+        index = cls(nprobe=nprobe)
+        with np.load(path) as data:
+            vectors = data["vectors"]
+            index.reserve(len(vectors))
+            index.vectors[: len(vectors)] = vectors
+            index.norms[: len(vectors)] = (vectors * vectors).sum(axis=1)
+            index.uris = data["uris"].tolist()
+            index.rows = {uri: row for row, uri in enumerate(index.uris)}
+            index.count = len(vectors)
+            index.synced = int(data["synced"])
+            if len(data["centroids"]):
+                index.centroids = data["centroids"]
+                index.cells[: index.count] = nearest_centroid(vectors, index.centroids)
+        return index
+
+
+def index_path():
+    return os.environ.get(
+        "SIMILAR_INDEX_PATH",
+        os.path.join(tempfile.gettempdir(), "spotify-data-visualizer.similar.npz"),
+    )
+
+
+# Load the similar-track index from SIMILAR_INDEX_PATH if it has been saved there,
+# else start an empty one; either way it catches up with the feature store when synced.
+def similar_index_from_environment():
+    path = index_path()
+    if os.path.exists(path):
+        return SimilarityIndex.load(path)
+    return SimilarityIndex()
+
+
+# Build the index from every track in the feature store and save it to SIMILAR_INDEX_PATH,
+# so app workers start from a saved index instead of indexing the whole store themselves.
+def main():
+    from feature_store import feature_store_from_environment
+
+    index = similar_index_from_environment()
+    index.sync(feature_store_from_environment())
+    index.save(index_path())
+    print("Indexed {} tracks in {}".format(len(index), index_path()))
+
+
+if __name__ == "__main__":
+    main()
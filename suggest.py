@@ -0,0 +1,87 @@
+import bisect
+import json
+import os
+import tempfile
+import threading
+import unicodedata
+
+
+# Fold a search query so that queries differing only in case, accents or spacing match:
+# "  Beyoncé   HALO " and "beyonce halo" both become "beyonce halo".
+def normalize_query(query):
+    decomposed = unicodedata.normalize("NFKD", query.casefold())
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.split())
+
+
+# A prefix index of search suggestions, kept as a sorted array of normalized keys so the
+# suggestions for a prefix are a contiguous slice found with two binary searches.
+# Each key maps to the label shown in the dropdown, which is also the query it searches for.
+# Holds at most max_entries suggestions; once full, new ones are ignored.
+class PrefixIndex:
+    def __init__(self, max_entries=50000):
+        self.max_entries = max_entries
+        self.keys = []
+        self.labels = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, label, key=None):
+        key = normalize_query(key or label)
+        if not key:
+            return
+        with self.lock:
+            i = bisect.bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                return
+            if len(self.keys) >= self.max_entries:
+                return
+            self.keys.insert(i, key)
+            self.labels.insert(i, label)
+
+    # Add a track found by a search, so it can be suggested by its title or its artist.
+    def add_track(self, title, artist):
+        label = "{} {}".format(title, artist)
+        self.add(label)
+        self.add(label, key="{} {}".format(artist, title))
+
+    # Labels of up to `limit` suggestions whose keys start with the normalized prefix.
+    def lookup(self, prefix, limit=8):
+        prefix = normalize_query(prefix)
+        if not prefix:
+            return []
+        with self.lock:
+            start = bisect.bisect_left(self.keys, prefix)
+            end = bisect.bisect_left(self.keys, prefix + "\uffff", lo=start)
+            return self.labels[start : min(end, start + limit)]
+
+    # Save the index to a JSON file, replacing the old file atomically.
+    def save(self, path):
+        with self.lock:
+            index = {"keys": self.keys, "labels": self.labels}
+            directory = os.path.dirname(os.path.abspath(path))
+            with tempfile.NamedTemporaryFile(
+                "w", dir=directory, suffix=".json", delete=False
+            ) as f:
+                json.dump(index, f, separators=(",", ":"))
+        os.replace(f.name, path)
+
+    @classmethod
+    def load(cls, path, max_entries=50000):
+        index = cls(max_entries)
+        with open(path) as f:
+            saved = json.load(f)
+        index.keys = saved["keys"][:max_entries]
+        index.labels = saved["labels"][:max_entries]
+        return index
+
+
+# Where the suggestions built from the response cache are saved for every worker to load,
+# set by SUGGESTIONS_PATH (defaults to a file in the system temp directory).
+def suggestions_path():
+    return os.environ.get(
+        "SUGGESTIONS_PATH",
+        os.path.join(tempfile.gettempdir(), "spotify-data-visualizer.suggestions.json"),
+    )
@@ -0,0 +1,84 @@
+import time
+from concurrent import futures
+import pytest
+from benchmarks.fake_spotify import FakeSpotify
+from client import CircuitBreaker, CircuitOpen, PooledSpotify, TokenBucket
+
+
+def make_client(fake, rate=100, threshold=5, cooldown=30):
+    sp = PooledSpotify(
+        limiter=TokenBucket(rate=rate, burst=rate),
+        breaker=CircuitBreaker(threshold=threshold, cooldown=cooldown),
+        auth="test",
+    )
+    sp.prefix = fake.prefix
+    return sp
+
+
+# Start a fake Spotify API with the given options and stop it after the test.
+@pytest.fixture
+def fake_api():
+    started = []
+
+    def start(**options):
+        fake = FakeSpotify(**options).start()
+        started.append(fake)
+        return fake
+
+    yield start
+    for fake in started:
+        fake.stop()
+
+
+def test_concurrent_calls_share_one_request(fake_api):
+    fake = fake_api(delays={"track": 0.3})
+    sp = make_client(fake)
+    with futures.ThreadPoolExecutor(max_workers=20) as pool:
+        tracks = list(pool.map(lambda _: sp.track("spotify:track:1"), range(20)))
+    assert fake.requests["track"] == 1
+    assert all(track == tracks[0] for track in tracks)
+
+
+def test_rate_limited_call_is_retried_after_retry_after(fake_api):
+    fake = fake_api(failures={"track": [429]}, retry_after=1)
+    sp = make_client(fake)
+    started = time.monotonic()
+    assert sp.track("spotify:track:1")["id"] == "1"
+    assert time.monotonic() - started >= 0.9
+    assert fake.requests["track"] == 2
+
+
+def test_open_circuit_fails_fast(fake_api):
+    fake = fake_api(failures={"track": [503] * 10})
+    sp = make_client(fake, threshold=3)
+    with pytest.raises(CircuitOpen):
+        sp.track("spotify:track:1")
+    assert fake.requests["track"] == 3
+    started = time.monotonic()
+    with pytest.raises(CircuitOpen):
+        sp.track("spotify:track:2")
+    assert time.monotonic() - started < 0.1
+    assert fake.requests["track"] == 3
+
+
+# After the cooldown, one trial request is let through while the others keep failing
+# fast; once it succeeds the circuit closes again.
+def test_half_open_circuit_lets_one_trial_through(fake_api):
+    fake = fake_api(failures={"track": [503] * 3}, delays={"track": 0.3})
+    sp = make_client(fake, threshold=3, cooldown=0.5)
+    with pytest.raises(CircuitOpen):
+        sp.track("spotify:track:1")
+    time.sleep(0.5)
+
+    def call(i):
+        try:
+            return sp.track("spotify:track:{}".format(i))
+        except CircuitOpen:
+            return None
+
+    with futures.ThreadPoolExecutor(max_workers=5) as pool:
+        tracks = list(pool.map(call, range(2, 7)))
+    assert sum(track is not None for track in tracks) == 1
+    assert fake.requests["track"] == 4
+    assert sp.track("spotify:track:7")["id"] == "7"
+    assert fake.requests["track"] == 5
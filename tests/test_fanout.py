@@ -0,0 +1,57 @@
+import os
+import tempfile
+import time
+from concurrent import futures
+import pytest
+import spotipy
+from benchmarks.fake_spotify import FakeSpotify
+
+scratch = tempfile.mkdtemp()
+os.environ.setdefault("SPOTIPY_CLIENT_ID", "test")
+os.environ.setdefault("SPOTIPY_CLIENT_SECRET", "test")
+os.environ["SPOTIFY_CACHE_PATH"] = os.path.join(scratch, "cache.sqlite")
+os.environ["FEATURE_STORE_PATH"] = os.path.join(scratch, "features")
+os.environ["SIMILAR_INDEX_PATH"] = os.path.join(scratch, "similar.npz")
+os.environ["SEGMENT_STORE_PATH"] = os.path.join(scratch, "segments")
+os.environ["SUGGESTIONS_PATH"] = os.path.join(scratch, "suggestions.json")
+os.environ["WAVEFORM_RENDER"] = "svg"
+import functions  # noqa: E402
+
+delays = {"track": 0.3, "audio_features": 0.3, "audio_analysis": 0.6}
+
+
+# Point the app's client at a fake Spotify API that takes `delays` seconds per endpoint.
+@pytest.fixture
+def fake():
+    fake = FakeSpotify(delays=delays).start()
+    client = functions.sp
+    functions.sp = spotipy.Spotify(auth="test", retries=0)
+    functions.sp.prefix = fake.prefix
+    yield fake
+    functions.sp = client
+    fake.stop()
+
+
+def test_calls_overlap(fake):
+    track_uri = "spotify:track:overlap"
+    started = time.monotonic()
+    waveform = functions.executor().submit(functions.get_waveform, track_uri)
+    functions.get_audio_features(track_uri)
+    assert waveform.result() is not None
+    assert time.monotonic() - started < sum(delays.values())
+
+
+def test_slow_audio_features_time_out(fake):
+    with pytest.raises(futures.TimeoutError):
+        functions.get_audio_features("spotify:track:slowfeatures", timeout=0.05)
+
+
+def test_slow_waveform_is_left_out(fake):
+    track_uri = "spotify:track:slowwaveform"
+    started = time.monotonic()
+    assert functions.get_waveform(track_uri, timeout=0.05) is None
+    assert time.monotonic() - started < delays["audio_analysis"]
+    # the waveform keeps rendering in the background and is cached for the next lookup
+    time.sleep(delays["audio_analysis"] * 2)
+    assert functions.get_waveform(track_uri, timeout=0.05) is not None
+    assert fake.requests["audio_analysis"] == 1
@@ -0,0 +1,229 @@
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import time
+from concurrent import futures
+from spotipy.exceptions import SpotifyException
+from batch import read_uris
+from client import BudgetExhausted, RequestBudget, TokenBucket
+from functions import (
+    api_cache,
+    chunks,
+    get_audio_analysis,
+    get_features_many,
+    get_metadata_many,
+    segment_store,
+    sp,
+    tracks_limit,
+    waveform_key,
+)
+
+
+logger = logging.getLogger("warmer")
+
+# What has to be cached for a track lookup to be served without calling the API or
+# rendering: its metadata, its audio features, its segments and its rendered waveform.
+stages = ("track", "audio_features", "audio_analysis", "waveform")
+
+
+# Which stages of a track are cached. Checking doesn't count as a cache hit or miss, so
+# the cache metrics of the app aren't skewed by the warmer.
+def cached_stages(track_uri):
+    return {
+        "track": api_cache.contains("track", track_uri),
+        "audio_features": api_cache.contains("audio_features", track_uri),
+        "audio_analysis": segment_store.contains(track_uri),
+        "waveform": api_cache.contains("waveform", waveform_key(track_uri)),
+    }
+
+
+# How many of the tracks have each stage cached, and how many have them all.
+def coverage(track_uris):
+    counts = dict.fromkeys(stages, 0)
+    counts["complete"] = 0
+    for track_uri in track_uris:
+        cached = cached_stages(track_uri)
+        for stage in stages:
+            counts[stage] += cached[stage]
+        counts["complete"] += all(cached.values())
+    return dict(counts, tracks=len(track_uris))
+
+
+# Keeps the caches filled with the tracks of a list of sources (such as chart playlists),
+# so visitors looking them up get cached responses and a pre-rendered waveform.
+# It runs in its own process next to the web workers, on the same machine (see
+# spawn_warmer), and shares their caches on disk. Every run reads the sources again and fetches what is missing, in source order so
+# the top of a chart is warmed first: metadata and audio features in batches and then the
+# audio analyses and waveform renders on `workers` threads. A run makes at most `budget`
+# API requests, at most `rate` per second, so the warmer leaves most of the rate limit to
+# visitors; once the budget is spent the rest waits for the next run.
+class CacheWarmer:
+    def __init__(self, sources, budget=500, rate=2, workers=4):
+        self.sources = sources
+        self.budget = budget
+        self.workers = workers
+        self.limiter = TokenBucket(rate=rate, burst=max(1, rate))
+
+    # The track URIs of every source, without duplicates, in source order. A source that
+    # can't be read is logged and skipped.
+    def track_uris(self):
+        track_uris = {}
+        for source in self.sources:
+            try:
+                track_uris.update(dict.fromkeys(read_uris(source)))
+            except (SpotifyException, ValueError, OSError):
+                logger.warning("Could not read source %s", source, exc_info=True)
+        return list(track_uris)
+
+    # Fetch and render whatever isn't cached for the tracks. Returns the number of tracks
+    # warmed, the number that failed (such as tracks without an audio analysis) and
+    # whether the run stopped because the budget was spent.
+    def warm(self, track_uris):
+        warmed = failed = 0
+        cold = [uri for uri in track_uris if not all(cached_stages(uri).values())]
+        try:
+            with futures.ThreadPoolExecutor(self.workers) as pool:
+                for chunk in chunks(cold, tracks_limit):
+                    get_metadata_many(
+                        [uri for uri in chunk if not api_cache.contains("track", uri)]
+                    )
+                    get_features_many(
+                        [
+                            uri
+                            for uri in chunk
+                            if not api_cache.contains("audio_features", uri)
+                        ]
+                    )
+                    renders = [pool.submit(get_audio_analysis, uri) for uri in chunk]
+                    for render in renders:
+                        try:
+                            render.result()
+                            warmed += 1
+                        except SpotifyException:
+                            failed += 1
+        except BudgetExhausted:
+            return warmed, failed, True
+        return warmed, failed, False
+
+    # Read the sources and warm their tracks, with a fresh request budget.
+    def run(self):
+        started = time.monotonic()
+        sp.limiter = budget = RequestBudget(self.limiter, self.budget)
+        track_uris = []
+        warmed = failed = 0
+        exhausted = False
+        try:
+            track_uris = self.track_uris()
+            warmed, failed, exhausted = self.warm(track_uris)
+        except BudgetExhausted:
+            exhausted = True
+        report = coverage(track_uris)
+        logger.info(
+            "Warmed %d tracks (%d failed) with %d requests in %.1fs%s; "
+            "%d of %d tracks fully cached",
+            warmed,
+            failed,
+            budget.used,
+            time.monotonic() - started,
+            ", budget spent" if exhausted else "",
+            report["complete"],
+            report["tracks"],
+        )
+        return report
+
+    # Run every `interval` seconds, forever.
+    def run_forever(self, interval):
+        while True:
+            started = time.monotonic()
+            try:
+                self.run()
+            except Exception:
+                logger.exception("Warming failed")
+            time.sleep(max(0, started + interval - time.monotonic()))
+
+
+# Build the cache warmer from environment variables. WARMER_SOURCES lists its sources
+# (playlist or album URIs/URLs, or files of track URIs) separated by commas or spaces,
+# WARMER_REQUEST_BUDGET the API requests it may make per run (default 500),
+# WARMER_RATE_LIMIT the requests it may make per second (default 2) and WARMER_WORKERS
+# the audio analyses and renders it runs at once (default 4).
+def warmer_from_environment(sources=None):
+    return CacheWarmer(
+        sources or os.environ.get("WARMER_SOURCES", "").replace(",", " ").split(),
+        budget=int(os.environ.get("WARMER_REQUEST_BUDGET", "500")),
+        rate=float(os.environ.get("WARMER_RATE_LIMIT", "2")),
+        workers=int(os.environ.get("WARMER_WORKERS", "4")),
+    )
+
+
+# Start the warmer in a child process (`python warmer.py`) if WARMER_SOURCES is set, and
+# return it, else None. The caches are files on the local disk, so the warmer has to run
+# on the same machine as the web workers; on Heroku, a separate process type would get a
+# dyno and a /tmp of its own. gunicorn.conf.py starts it from the master process.
+def spawn_warmer():
+    if not os.environ.get("WARMER_SOURCES", "").strip():
+        return None
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)])
+
+
+# Print the cache coverage of every source: how many of its tracks have each stage cached.
+def print_status(warmer):
+    columns = ("tracks",) + stages + ("complete",)
+    print("{:<48}".format("source") + "".join("{:>16}".format(c) for c in columns))
+    for source in warmer.sources:
+        try:
+            report = coverage(list(dict.fromkeys(read_uris(source))))
+        except (SpotifyException, ValueError, OSError) as e:
+            print("{:<48} {}".format(source, e))
+            continue
+        print(
+            "{:<48}{:>16}".format(source, report["tracks"])
+            + "".join(
+                "{:>16}".format(
+                    "{} ({:.0%})".format(
+                        report[column], report[column] / max(1, report["tracks"])
+                    )
+                )
+                for column in columns[1:]
+            )
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Keep the caches filled with the tracks of chart playlists and other sources."
+    )
+    parser.add_argument(
+        "sources",
+        nargs="*",
+        help="playlist or album URIs/URLs, or files of track URIs (default WARMER_SOURCES)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=float(os.environ.get("WARMER_INTERVAL", "3600")),
+        help="seconds between runs (default WARMER_INTERVAL or 3600)",
+    )
+    parser.add_argument("--once", action="store_true", help="run once and exit")
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="print the cache coverage of every source and exit",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    warmer = warmer_from_environment(args.sources)
+    if not warmer.sources:
+        parser.error("no sources given and WARMER_SOURCES is not set")
+    if args.status:
+        print_status(warmer)
+    elif args.once:
+        warmer.run()
+    else:
+        warmer.run_forever(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+from base64 import b64decode, b64encode
+import numpy as np
+
+
+# Loudness (dB) below this value is drawn as silence when building a waveform.
+loudness_floor = -35
+
+# Ways of reducing the segments that fall inside a bin to a single level.
+# "sample" picks the segment playing at the start of the bin (the original behaviour),
+# the others aggregate every segment that overlaps the bin.
+aggregations = ("sample", "max", "mean", "rms")
+
+# Ways a waveform can be sent to the browser, see functions.render_waveform.
+render_modes = ("png", "svg", "graph", "pyramid")
+
+# Resolutions (bin counts) of a waveform pyramid, see build_pyramid.
+pyramid_bins = (64, 256, 1024, 4096)
+
+
+# One field of every segment as a float array. Segments are either the list of dicts of an
+# audio analysis or a mapping of field names to arrays, such as a segments.SegmentFile.
+def segment_field(segments, name):
+    if isinstance(segments, list):
+        values = (s[name] for s in segments)
+        return np.fromiter(values, dtype=float, count=len(segments))
+    return np.asarray(segments[name], dtype=float)
+
+
+# Convert the segments of an audio analysis into arrays of normalized start, end and level.
+# Start and end are fractions of the track duration, level is loudness_max clipped to
+# [loudness_floor, 0] and mapped onto [0, 1].
+def segment_arrays(segments, duration):
+    count = len(segments)
+    starts = segment_field(segments, "start")
+    durations = segment_field(segments, "duration")
+    loudness = segment_field(segments, "loudness_max")
+    starts = starts / duration
+    ends = starts + durations / duration
+    levels = 1 - (np.clip(loudness, loudness_floor, 0) / loudness_floor)
+    if count > 1 and np.any(np.diff(starts) < 0):
+        order = np.argsort(starts, kind="stable")
+        starts, ends, levels = starts[order], ends[order], levels[order]
+    return starts, ends, levels
+
+
+# Find the first segment covering each position, using a running maximum of segment ends
+# so overlapping and touching segments resolve to the earliest one like a linear scan would.
+# Returns the segment index for each position, or -1 where no segment covers it.
+def locate(starts, ends, positions):
+    if len(starts) == 0:
+        return np.full(len(positions), -1)
+    reach = np.maximum.accumulate(ends)
+    first = np.searchsorted(reach, positions, side="left")
+    last = np.searchsorted(starts, positions, side="right") - 1
+    return np.where(first <= last, first, -1)
+
+
+# Reduce the segments overlapping each bin [edges[k], edges[k + 1]) with the given aggregation.
+# Returns the aggregated level for each bin and a mask of bins that contain any segment.
+def aggregate_bins(starts, ends, levels, edges, aggregation):
+    reach = np.maximum.accumulate(ends) if len(ends) else ends
+    lo = np.searchsorted(reach, edges[:-1], side="right")
+    hi = np.searchsorted(starts, edges[1:], side="left")
+    filled = hi > lo
+    values = np.zeros(len(lo))
+    if not filled.any():
+        return values, filled
+    if aggregation == "max":
+        # reduceat needs non-empty, in-bounds ranges, so only reduce the filled bins
+        bounds = np.empty(2 * filled.sum(), dtype=int)
+        bounds[0::2] = lo[filled]
+        bounds[1::2] = hi[filled]
+        padded = np.append(levels, 0)
+        values[filled] = np.maximum.reduceat(padded, bounds)[0::2]
+    else:
+        squared = aggregation == "rms"
+        totals = np.concatenate(([0.0], np.cumsum(levels ** 2 if squared else levels)))
+        counts = np.where(filled, hi - lo, 1)
+        values = np.where(filled, (totals[hi] - totals[lo]) / counts, 0.0)
+        if squared:
+            values = np.sqrt(values)
+    return values, filled
+
+
+# Level of every bin starting at the given positions (bins end where the next one starts,
+# the last one at the end of the track). Returns the levels and a mask of the bins that
+# any segment covers; the levels of the other bins are 0.
+def dense_levels(starts, ends, levels, positions, aggregation):
+    if aggregation == "sample":
+        found = locate(starts, ends, positions)
+        filled = found >= 0
+        values = np.zeros(len(positions))
+        values[filled] = levels[found[filled]]
+        return values, filled
+    edges = np.append(positions, 1.0)
+    return aggregate_bins(starts, ends, levels, edges, aggregation)
+
+
+# One field of every row of another table of an audio analysis ("bars", "beats", "tatums"
+# or "sections"), from either the JSON analysis or a segments.SegmentFile.
+def interval_field(audio_analysis, table, name):
+    if isinstance(audio_analysis, dict):
+        return segment_field(audio_analysis.get(table) or [], name)
+    return np.asarray(audio_analysis.table(table)[name], dtype=float)
+
+
+# The musical structure of a track, to draw over its waveform: the start of every bar and
+# beat and, for every section, its start, its end and its energy (the duration-weighted
+# mean level of the segments starting in it, scaled like the waveform so the loudest
+# segment of the track has a level of 1). Positions are fractions of the track duration.
+# Takes the JSON audio analysis or a segments.SegmentFile, and works on whole arrays: one
+# binary search places every segment in its section and two weighted counts sum them up.
+def track_structure(audio_analysis, duration):
+    if isinstance(audio_analysis, dict):
+        segments = audio_analysis["segments"]
+    else:
+        segments = audio_analysis
+    starts, ends, levels = segment_arrays(segments, duration)
+    section_starts = interval_field(audio_analysis, "sections", "start") / duration
+    if len(section_starts) == 0:
+        section_starts = np.zeros(1)
+    section_ends = np.append(section_starts[1:], 1.0)
+    sections = len(section_starts)
+    section = np.searchsorted(section_starts, starts, side="right") - 1
+    section = np.clip(section, 0, sections - 1)
+    weights = ends - starts
+    covered = np.bincount(section, weights=weights, minlength=sections)
+    energy = np.bincount(section, weights=weights * levels, minlength=sections)
+    energy = energy / np.where(covered > 0, covered, 1)
+    maximum = levels.max() if len(levels) and levels.max() > 0 else 1
+    return {
+        "sections": np.stack([section_starts, section_ends, energy / maximum], axis=1),
+        "bars": interval_field(audio_analysis, "bars", "start") / duration,
+        "beats": interval_field(audio_analysis, "beats", "start") / duration,
+    }
+
+
+# Bin the segments of an audio analysis into waveform levels.
+# Returns the x index of every drawn bar (on a 0 to 1000 scale) and its level in [0, 1],
+# normalized so the loudest segment of the track has a level of 1.
+# With the defaults this reproduces the original 125-bar waveform exactly.
+def bin_levels(segments, duration, bins=125, aggregation="sample"):
+    if aggregation not in aggregations:
+        raise ValueError("Unknown aggregation: {}".format(aggregation))
+    starts, ends, levels = segment_arrays(segments, duration)
+    if len(levels) == 0:
+        return np.zeros(0), np.zeros(0)
+    maximum = levels.max()
+    index = np.arange(bins) * 1000 / bins
+    values, filled = dense_levels(starts, ends, levels, index / 1000, aggregation)
+    return index[filled], values[filled] / maximum
+
+
+# Build a waveform pyramid: the levels of the whole track at several resolutions, stored
+# as float16 to keep them compact. Bins no segment covers have a level of 0. Zooming into
+# part of the track is then a matter of picking a resolution and slicing (see
+# pyramid_range), without binning the analysis again.
+# Returns a dict of bin count to levels.
+def build_pyramid(segments, duration, resolutions=pyramid_bins, aggregation="max"):
+    if aggregation not in aggregations:
+        raise ValueError("Unknown aggregation: {}".format(aggregation))
+    starts, ends, levels = segment_arrays(segments, duration)
+    maximum = levels.max() if len(levels) and levels.max() > 0 else 1
+    pyramid = {}
+    for bins in resolutions:
+        positions = np.arange(bins) / bins
+        values, filled = dense_levels(starts, ends, levels, positions, aggregation)
+        pyramid[bins] = (values / maximum).astype(np.float16)
+    return pyramid
+
+
+# Levels for the part of a track between start and end (fractions of its duration), for
+# drawing about `bars` bars. Uses the coarsest resolution with at least that many bins
+# in the range, or the finest one when zoomed in further than it goes.
+# Returns the start position of each bin (as a fraction of the duration) and its level.
+def pyramid_range(pyramid, start, end, bars):
+    start, end = max(0.0, start), min(1.0, end)
+    resolutions = sorted(pyramid)
+    bins = next((b for b in resolutions if b * (end - start) >= bars), resolutions[-1])
+    first = int(np.floor(start * bins))
+    last = max(first + 1, int(np.ceil(end * bins)))
+    return np.arange(first, last) / bins, pyramid[bins][first:last]
+
+
+# Encode a pyramid as JSON-serializable data, with each resolution's float16 levels
+# base64 encoded, so it can be cached and decoded in the browser. The track's structure
+# (see track_structure) can be sent along to be drawn over the waveform.
+def encode_pyramid(pyramid, duration, structure=None):
+    encoded = {
+        "duration": duration,
+        "levels": {
+            str(bins): b64encode(levels.astype("<f2").tobytes()).decode()
+            for bins, levels in pyramid.items()
+        },
+    }
+    if structure is not None:
+        encoded["structure"] = {
+            name: np.round(values, 5).tolist() for name, values in structure.items()
+        }
+    return encoded
+
+
+def decode_pyramid(data):
+    return {
+        int(bins): np.frombuffer(b64decode(levels), dtype="<f2")
+        for bins, levels in data["levels"].items()
+    }
+
+
+# Draw a track's structure (see track_structure) as SVG elements for a waveform drawn 1000
+# wide and 1 high, with the start of the track at x = left: every section shaded as
+# brightly as it is energetic, a line at the start of every bar and a tick at the bottom
+# for every beat.
+def structure_svg(structure, color, left=0):
+    sections = "".join(
+        '<rect x="{}" width="{}" height="1" fill="{}" fill-opacity="{}"/>'.format(
+            round(left + start * 1000, 2),
+            round((end - start) * 1000, 2),
+            color,
+            round(0.04 + 0.16 * energy, 3),
+        )
+        for start, end, energy in structure["sections"].tolist()
+    )
+    bars = "".join(
+        "M{} 0v1".format(x)
+        for x in np.round(left + structure["bars"] * 1000, 2).tolist()
+    )
+    beats = "".join(
+        "M{} 0.97v0.03".format(x)
+        for x in np.round(left + structure["beats"] * 1000, 2).tolist()
+    )
+    return (
+        '{sections}<path d="{bars}" stroke="{color}" stroke-opacity="0.25" '
+        'stroke-width="1" vector-effect="non-scaling-stroke" fill="none"/>'
+        '<path d="{beats}" stroke="{color}" stroke-opacity="0.5" '
+        'stroke-width="1" vector-effect="non-scaling-stroke" fill="none"/>'
+    ).format(sections=sections, bars=bars, beats=beats, color=color)
+
+
+# Draw waveform levels as a standalone SVG document, so the browser can render the bars
+# without a headless browser on the server. Every bar is mirrored around the middle of
+# the image and all bars share one path to keep the markup small. The track's structure
+# is drawn behind the bars when given.
+def levels_svg(index, levels, color, background, width=700, height=500, structure=None):
+    spacing = np.min(np.diff(index)) if len(index) > 1 else 1000
+    left = round(-spacing / 2, 2)
+    if structure is None:
+        overlay = ""
+    else:
+        overlay = structure_svg(structure, "#ffffff", left)
+    bar_width = spacing * 0.8
+    x = np.round(index - bar_width / 2, 2)
+    top = np.round(0.5 - levels / 2, 4)
+    bar_height = np.round(levels, 4)
+    path = "".join(
+        "M{} {}h{}v{}h-{}z".format(x0, y0, round(bar_width, 2), h, round(bar_width, 2))
+        for x0, y0, h in zip(x.tolist(), top.tolist(), bar_height.tolist())
+    )
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        'viewBox="{left} 0 1000 1" preserveAspectRatio="none">'
+        '<rect x="{left}" width="1000" height="1" fill="{background}"/>'
+        '{overlay}<path d="{path}" fill="{color}"/></svg>'
+    ).format(
+        width=width,
+        height=height,
+        left=left,
+        background=background,
+        overlay=overlay,
+        path=path,
+        color=color,
+    )